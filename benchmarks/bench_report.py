@@ -0,0 +1,191 @@
+"""
+Бенчмарк агрегации отчётов на синтетическом листе.
+
+Сравнивает построчный разбор (как было в handle_report: цикл по строкам, два strptime,
+safe_float на ячейку, merge/apply при группировке) с колоночным конвейером из reports.py:
+разбор всего листа в суммы по (пользователь, день) и построение ряда для одного отчёта.
+
+    python benchmarks/bench_report.py                 # 10k, 100k, 1M строк
+    python benchmarks/bench_report.py --rows 50000 --users 500
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import reports  # noqa: E402
+
+
+def make_rows(n_rows, n_users, today, seed=42):
+    """
+    Синтетический лист: две формы дат, десятичные запятые, часть строк без калорий
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        day = today - timedelta(days=rnd.randint(0, 730))
+        date_str = day.strftime("%Y-%m-%d") if rnd.random() < 0.8 else day.strftime("%d.%m.%Y")
+        has_cal = rnd.random() > 0.05
+        rows.append([
+            date_str, "12:00:00", str(rnd.randint(1, n_users)), "user", "продукт",
+            f"{rnd.uniform(10, 400):.0f}",
+            f"{rnd.uniform(10, 900):.1f}".replace(".", ",") if has_cal else "",
+            f"{rnd.uniform(0, 50):.1f}", f"{rnd.uniform(0, 50):.1f}", f"{rnd.uniform(0, 90):.1f}",
+            f"id{i}",
+        ])
+    return rows
+
+
+# --- Как было: построчный разбор и группировка с merge/apply ---
+def _safe_float(value):
+    try:
+        return float(str(value).replace(",", "."))
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def legacy_series(rows, user_id, period, today):
+    records = []
+    for row in rows:
+        try:
+            if row[2].strip() != user_id:
+                continue
+            cal = row[6].strip()
+            if not cal:
+                continue
+            try:
+                date_obj = datetime.strptime(row[0].strip(), "%Y-%m-%d").date()
+            except ValueError:
+                try:
+                    date_obj = datetime.strptime(row[0].strip(), "%d.%m.%Y").date()
+                except ValueError:
+                    continue
+            records.append({
+                "date": date_obj, "grams": _safe_float(row[5]), "cal": _safe_float(cal),
+                "prot": _safe_float(row[7]), "fat": _safe_float(row[8]), "carb": _safe_float(row[9]),
+            })
+        except Exception:
+            continue
+    df_all = pd.DataFrame(records)
+    df_all["date"] = pd.to_datetime(df_all["date"]).dt.date
+    if period == "today":
+        chart_start = today - timedelta(days=29)
+        df_chart = df_all[(df_all["date"] >= chart_start) & (df_all["date"] <= today)]
+        g = pd.DataFrame(df_chart).assign(date=pd.to_datetime(df_chart["date"])).groupby("date").sum(numeric_only=True).reset_index()
+        full_df = pd.DataFrame({"date": pd.date_range(start=chart_start, end=today, freq="D")})
+        grouped = full_df.merge(g, on="date", how="left").fillna(0)
+        grouped["label"] = grouped["date"].dt.strftime("%d.%m.%y")
+    elif period == "week":
+        this_monday = today - timedelta(days=today.weekday())
+        chart_start = this_monday - timedelta(weeks=11)
+        df_chart = df_all[(df_all["date"] >= chart_start) & (df_all["date"] <= today)]
+        df_tmp = pd.DataFrame(df_chart).assign(date=pd.to_datetime(df_chart["date"]))
+        iso = df_tmp["date"].dt.isocalendar()
+        df_tmp["year"] = iso.year.astype(int)
+        df_tmp["week"] = iso.week.astype(int)
+        g = df_tmp.groupby(["year", "week"]).sum(numeric_only=True).reset_index()
+        iso_rng = pd.date_range(start=chart_start, end=this_monday, freq="W-MON").isocalendar()
+        full_df = pd.DataFrame({"year": iso_rng.year.astype(int), "week": iso_rng.week.astype(int)}).drop_duplicates()
+        grouped = full_df.merge(g, on=["year", "week"], how="left").fillna(0)
+        grouped["label"] = grouped["week"].astype(int).astype(str)
+    else:
+        months_rng = pd.date_range(end=today.replace(day=1), periods=12, freq="MS")
+        chart_start = months_rng.min().date()
+        df_chart = df_all[(df_all["date"] >= chart_start) & (df_all["date"] <= today)]
+        df_tmp = pd.DataFrame(df_chart).assign(date=pd.to_datetime(df_chart["date"]))
+        df_tmp["year"] = df_tmp["date"].dt.year
+        df_tmp["month"] = df_tmp["date"].dt.month
+        g = df_tmp.groupby(["year", "month"]).sum(numeric_only=True).reset_index()
+        full_df = pd.DataFrame({"year": months_rng.year, "month": months_rng.month})
+        grouped = full_df.merge(g, on=["year", "month"], how="left").fillna(0)
+        grouped["label"] = grouped.apply(lambda r: f"{int(r['month']):02d}.{int(r['year']) % 100:02d}", axis=1)
+    return grouped
+
+
+def legacy_daily_totals(rows):
+    """
+    Разбор всего листа построчно в суммы по (user_id, день) — как при старте без журнала
+    """
+    totals = {}
+    for row in rows:
+        if len(row) < 10 or not row[6].strip():
+            continue
+        try:
+            day = datetime.strptime(row[0].strip(), "%Y-%m-%d").date()
+        except ValueError:
+            try:
+                day = datetime.strptime(row[0].strip(), "%d.%m.%Y").date()
+            except ValueError:
+                continue
+        acc = totals.setdefault((row[2].strip(), day), [0.0] * 5)
+        for i, cell in enumerate(row[5:10]):
+            acc[i] += _safe_float(cell)
+    return totals
+
+
+# --- Колоночный конвейер ---
+def columnar_daily_totals(rows):
+    frame = reports.load_sheet_frame(rows)
+    frame = frame[frame["cal"].notna() & frame["date"].notna()]
+    return frame.groupby(["user_id", "date"])[list(reports.NUMERIC_COLUMNS)].sum(min_count=0).fillna(0.0)
+
+
+
+def columnar_series(frame, user_id, period, today):
+    user = frame[(frame["user_id"] == user_id) & frame["cal"].notna()]
+    return reports.bucket_series(user.fillna({c: 0.0 for c in reports.NUMERIC_COLUMNS}), period, today)
+
+
+def _timed(func, *args, repeat=3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run(n_rows, n_users, today):
+    rows = make_rows(n_rows, n_users, today)
+    user_id = "1"
+    repeat = 1 if n_rows >= 500_000 else 3
+
+    t_load, frame = _timed(reports.load_sheet_frame, rows, repeat=repeat)
+    print(f"\n{n_rows:>9,} строк, {n_users} пользователей; разбор листа в колонки: {t_load * 1000:9.1f} мс")
+    t_old, old = _timed(legacy_daily_totals, rows, repeat=repeat)
+    t_new, new = _timed(columnar_daily_totals, rows, repeat=repeat)
+    same = len(old) == len(new) and all(
+        abs(a - b) < 1e-6
+        for (user, day), sums in old.items()
+        for a, b in zip(sums, new.loc[(user, pd.Timestamp(day))])
+    )
+    print(
+        f"  весь лист построчно {t_old * 1000:9.1f} мс | колоночно {t_new * 1000:8.1f} мс "
+        f"(x{t_old / max(t_new, 1e-9):6.1f}) | совпадает: {'да' if same else 'НЕТ'}"
+    )
+    for period in ("today", "week", "month"):
+        t_old, old = _timed(legacy_series, rows, user_id, period, today, repeat=repeat)
+        t_new, new = _timed(columnar_series, frame, user_id, period, today, repeat=repeat)
+        same = list(old["label"]) == list(new["label"]) and all(
+            (old[c] - new[c]).abs().max() < 1e-6 for c in reports.NUMERIC_COLUMNS
+        )
+        print(
+            f"  {period:<6} построчно {t_old * 1000:9.1f} мс | колоночно {t_new * 1000:8.1f} мс "
+            f"(x{t_old / max(t_new, 1e-9):6.1f}) | совпадает: {'да' if same else 'НЕТ'}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="*", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args()
+    today = date.today()
+    for n in args.rows:
+        run(n, args.users, today)
@@ -0,0 +1,163 @@
+"""
+Поддельные gspread Spreadsheet/Worksheet в памяти для бенчмарков: те же методы, что
+использует бот, с настраиваемой задержкой и долей ошибок на каждый вызов API.
+"""
+import random
+import threading
+import time
+
+from gspread.exceptions import WorksheetNotFound
+
+
+class FakeAPIError(Exception):
+    """
+    Имитация ответа 429/5xx от Google Sheets API
+    """
+
+
+class FakeSpreadsheet:
+    def __init__(self, title="FoodLog", latency=0.0, error_rate=0.0):
+        self.title = title
+        self.latency = latency
+        self.error_rate = error_rate
+        self.sheets = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+        self._next_id = 0
+
+    def _api_call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise FakeAPIError("injected Sheets API error")
+
+    def worksheet(self, title):
+        if title not in self.sheets:
+            raise WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows=1000, cols=11):
+        self._api_call()
+        self._next_id += 1
+        self.sheets[title] = FakeWorksheet(self, title, self._next_id, cols)
+        return self.sheets[title]
+
+    def batch_update(self, body):
+        self._api_call()
+        by_id = {ws.id: ws for ws in self.sheets.values()}
+        for request in body["requests"]:
+            rng = request["deleteDimension"]["range"]
+            ws = by_id[rng["sheetId"]]
+            with ws.lock:
+                del ws.rows[rng["startIndex"]:rng["endIndex"]]
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, sheet_id, cols=11):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.col_count = cols
+        self.rows = []
+        self.lock = threading.Lock()
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def get_all_values(self):
+        self.spreadsheet._api_call()
+        with self.lock:
+            return [list(row) + [""] * (self.col_count - len(row)) for row in self.rows]
+
+    def get(self, range_name):
+        """
+        Диапазон вида A2:K5001; как в API, пустые ячейки и строки в конце отбрасываются
+        """
+        self.spreadsheet._api_call()
+        first, last = range_name.split(":")
+        start, end = int(first[1:]) - 1, int(last[1:])
+        width = ord(last[0].upper()) - ord("A") + 1
+        with self.lock:
+            rows = [list(row[:width]) for row in self.rows[start:end]]
+        for row in rows:
+            while row and row[-1] == "":
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def col_values(self, col):
+        self.spreadsheet._api_call()
+        with self.lock:
+            values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def add_cols(self, cols):
+        self.spreadsheet._api_call()
+        self.col_count += cols
+
+    def update(self, range_name, values):
+        """
+        Только то, что нужно боту: запись одной колонки вида K1:K100
+        """
+        self.spreadsheet._api_call()
+        column = ord(range_name[0].upper()) - ord("A")
+        start = int(range_name.split(":")[0][1:]) - 1
+        with self.lock:
+            for offset, (value,) in enumerate(values):
+                row = self.rows[start + offset]
+                row.extend([""] * (column + 1 - len(row)))
+                row[column] = value
+
+    def batch_update(self, data, value_input_option="RAW"):
+        """
+        Запись нескольких диапазонов одной строки каждый (F5:J5) за один вызов API
+        """
+        self.spreadsheet._api_call()
+        with self.lock:
+            for item in data:
+                first = item["range"].split(":")[0]
+                column, row = ord(first[0].upper()) - ord("A"), int(first[1:]) - 1
+                target = self.rows[row]
+                values = ["" if v is None else str(v) for v in item["values"][0]]
+                target.extend([""] * (column + len(values) - len(target)))
+                target[column:column + len(values)] = values
+
+    def append_row(self, row, value_input_option="RAW"):
+        self.append_rows([row], value_input_option)
+
+    def append_rows(self, rows, value_input_option="RAW"):
+        self.spreadsheet._api_call()
+        with self.lock:
+            self.rows.extend(["" if v is None else str(v) for v in row] for row in rows)
+
+
+class FakeClient:
+    """
+    Замена gspread.Client: open(name) возвращает (и создаёт) таблицу в памяти
+    """
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.books = {}
+
+    def set_faults(self, latency=None, error_rate=None):
+        """
+        Меняет задержку и долю ошибок у клиента и всех уже открытых таблиц
+        """
+        if latency is not None:
+            self.latency = latency
+        if error_rate is not None:
+            self.error_rate = error_rate
+        for book in self.books.values():
+            book.latency, book.error_rate = self.latency, self.error_rate
+
+    def open(self, name):
+        if name not in self.books:
+            self.books[name] = FakeSpreadsheet(name, self.latency, self.error_rate)
+        return self.books[name]
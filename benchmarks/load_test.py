@@ -0,0 +1,336 @@
+"""
+Нагрузочный прогон бота без сети: обработчики bot.py получают синтетические апдейты,
+Telegram заменён заглушкой, OpenAI — fake_openai_server.py, Google Sheets — fake_sheets.py.
+У всех трёх настраиваются задержка и доля ошибок.
+
+Каждый виртуальный пользователь шлёт текстовые записи, каждое третье сообщение — фото
+с нажатием «Принять как есть», каждое пятое — /report, в конце — «Очистить сегодня».
+Для каждого числа одновременных пользователей печатаются p50/p99 по типам апдейтов,
+p50 времени до первого ответа (заглушки при STREAM_REPLIES=1) и пропускная способность.
+
+    python benchmarks/load_test.py --users 1 10 50 --messages 20
+    python benchmarks/load_test.py --openai-latency 0.8 --sheets-latency 0.3 --save baseline.json
+    python benchmarks/load_test.py --openai-error-rate 0.1 --baseline baseline.json
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import warnings
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+DISHES = (
+    "овсянка", "гречка с курицей", "борщ", "омлет из двух яиц", "творог 5%", "банан", "яблоко",
+    "салат цезарь", "плов", "кофе с молоком", "пельмени", "сырники", "рис с овощами", "шоколад",
+)
+PERIODS = ("today", "week", "month")
+warnings.filterwarnings("ignore", message="Glyph .* missing from font")  # эмодзи в легенде графика
+# Ответы бота, означающие деградацию (ChatGPT недоступен, очередь, лимит, ошибка)
+DEGRADED_MARKS = ("⚠️", "❌", "⏳", "Не получилось")
+# Ответы Telegram текущего апдейта: (время, текст); задачи обработчика наследуют контекст
+_REPLIES = contextvars.ContextVar("replies", default=None)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def make_photo(rnd):
+    """
+    Небольшой JPEG с цветными полосами: у разных фото разный перцептивный хэш
+    """
+    from PIL import Image
+    img = Image.new("RGB", (1280, 960))
+    for band in range(8):
+        color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+        img.paste(color, (band * 160, 0, band * 160 + 160, 960))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+class FakeTelegram:
+    """
+    Заглушка Bot API: каждый вызов ждёт latency и считается; сообщения получают возрастающие id
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.next_message_id = 0
+        self.files = {}
+        self.replies = []
+
+    async def _call(self, text=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if text is not None:
+            self.replies.append(text)
+            sink = _REPLIES.get()
+            if sink is not None:
+                sink.append((time.perf_counter(), text))  # пользователь увидел ответ
+
+    def message(self, user, **fields):
+        self.next_message_id += 1
+        message = SimpleNamespace(
+            message_id=self.next_message_id, from_user=user, text=None, photo=None, reply_to_message=None,
+        )
+        message.reply_text = self._reply_text
+        message.edit_text = functools.partial(self._edit_text, message)
+        message.__dict__.update(fields)
+        return message
+
+    async def _reply_text(self, text, reply_markup=None, **kwargs):
+        await self._call(text)
+        sent = self.message(None, text=text)
+        sent.reply_markup = reply_markup
+        return sent
+
+    async def _edit_text(self, message, text, reply_markup=None, **kwargs):
+        await self._call(text)
+        message.text, message.reply_markup = text, reply_markup
+        return message
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        return await self._reply_text(text, reply_markup)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self._call()
+
+    async def get_file(self, file_id):
+        await self._call()
+        data = self.files[file_id]
+
+        async def download_as_bytearray():
+            await self._call()
+            return bytearray(data)
+        return SimpleNamespace(file_id=file_id, download_as_bytearray=download_as_bytearray)
+
+
+class VirtualUser:
+    def __init__(self, bot, tg, user_id, messages, seed, photo_pool):
+        self.bot = bot
+        self.tg = tg
+        self.user = SimpleNamespace(id=user_id, username=f"load{user_id}", first_name="Load")
+        self.messages = messages
+        self.rnd = random.Random(seed)
+        self.photo_pool = photo_pool
+        self.update_id = 0
+        self.timings = []  # (тип апдейта, секунды, упал ли, деградировал ли, секунды до первого ответа)
+
+    def update(self, message=None, callback_query=None):
+        self.update_id += 1
+        return SimpleNamespace(
+            update_id=self.user.id * 100000 + self.update_id, message=message, callback_query=callback_query,
+            effective_chat=SimpleNamespace(id=self.user.id), effective_user=self.user,
+        )
+
+    def context(self, args=()):
+        return SimpleNamespace(args=list(args), bot=self.tg)
+
+    async def send(self, kind, handler, update, context):
+        replies = []
+        token = _REPLIES.set(replies)
+        started = time.perf_counter()
+        failed = False
+        try:
+            await handler(update, context)
+        except Exception:
+            failed = True
+        finally:
+            _REPLIES.reset(token)
+        seconds = time.perf_counter() - started
+        degraded = any(mark in text for _, text in replies for mark in DEGRADED_MARKS)
+        first = replies[0][0] - started if replies else seconds
+        self.timings.append((kind, seconds, failed, degraded, first))
+
+    async def text(self):
+        text = f"{self.rnd.choice(DISHES)} {self.rnd.randrange(50, 400, 10)}г"
+        update = self.update(self.tg.message(self.user, text=text))
+        await self.send("text", self.bot.instrumented(self.bot.handle_text), update, self.context())
+
+    async def photo(self):
+        # часть фото «пересылают» повторно: тот же file_unique_id
+        unique_id, data = self.rnd.choice(self.photo_pool)
+        file_id = f"{unique_id}-{self.update_id}"
+        self.tg.files[file_id] = data
+        sizes = [
+            SimpleNamespace(width=w, height=h, file_id=file_id, file_unique_id=unique_id)
+            for w, h in ((320, 240), (800, 600), (1280, 960))
+        ]
+        message = self.tg.message(self.user, photo=sizes)
+        sent = []
+        original_reply = message.reply_text
+
+        async def reply_text(text, reply_markup=None, **kwargs):
+            result = await original_reply(text, reply_markup)
+            sent.append(result)
+            return result
+        message.reply_text = reply_text
+        await self.send("photo", self.bot.instrumented(self.bot.handle_photo), self.update(message), self.context())
+        prompt = next((m for m in sent if m.reply_markup is not None), None)
+        if prompt is not None:
+            await self.button("accept_photo", prompt)
+
+    async def button(self, data, message=None):
+        async def answer(*args, **kwargs):
+            await self.tg._call()
+
+        async def edit_message_text(text, **kwargs):
+            await self.tg._call(text)
+        query = SimpleNamespace(
+            data=data, from_user=self.user, message=message or self.tg.message(None),
+            answer=answer, edit_message_text=edit_message_text,
+        )
+        await self.send(data, self.bot.instrumented(self.bot.button_handler),
+                        self.update(callback_query=query), self.context())
+
+    async def report(self):
+        period = self.rnd.choice(PERIODS)
+        update = self.update(self.tg.message(self.user, text=f"/report {period}"))
+        await self.send("report", self.bot.instrumented(self.bot.handle_report), update, self.context([period]))
+
+    async def run(self):
+        for i in range(self.messages):
+            await self.text()
+            if i % 3 == 2:
+                await self.photo()
+            if i % 5 == 4:
+                await self.report()
+        await self.button("clear_today")
+
+
+def summarize(timings, elapsed):
+    by_kind = {}
+    for kind, seconds, failed, degraded, first in timings:
+        by_kind.setdefault(kind, []).append((seconds, failed, degraded, first))
+    result = {"updates": len(timings), "seconds": round(elapsed, 3),
+              "per_sec": round(len(timings) / max(elapsed, 1e-9), 2), "kinds": {}}
+    for kind, items in sorted(by_kind.items()):
+        seconds = [s for s, _, _, _ in items]
+        result["kinds"][kind] = {
+            "n": len(items),
+            "p50_ms": round(percentile(seconds, 0.5) * 1000, 1),
+            "p99_ms": round(percentile(seconds, 0.99) * 1000, 1),
+            "max_ms": round(max(seconds) * 1000, 1),
+            "first_p50_ms": round(percentile([f for _, _, _, f in items], 0.5) * 1000, 1),
+            "errors": sum(failed for _, failed, _, _ in items),
+            "degraded": sum(degraded for _, _, degraded, _ in items),
+        }
+    return result
+
+
+def print_result(users, result, baseline=None):
+    def delta(key, value, base):
+        if base is None or key not in base or not base[key]:
+            return ""
+        return f" ({(value - base[key]) / base[key] * 100:+.0f}%)"
+
+    base = (baseline or {}).get(str(users))
+    print(f"\n{users} польз.: {result['updates']} апдейтов за {result['seconds']:.2f} с, "
+          f"{result['per_sec']:.1f} апд/с{delta('per_sec', result['per_sec'], base)}")
+    print(f"  {'тип':<13}{'n':>6}{'p50, мс':>18}{'p99, мс':>18}{'max, мс':>10}{'1-й ответ p50':>22}"
+          f"{'ошибки':>8}{'деград.':>9}")
+    for kind, row in result["kinds"].items():
+        base_row = base["kinds"].get(kind) if base else None
+        print(
+            f"  {kind:<13}{row['n']:>6}"
+            f"{row['p50_ms']:>9.1f}{delta('p50_ms', row['p50_ms'], base_row):>9}"
+            f"{row['p99_ms']:>9.1f}{delta('p99_ms', row['p99_ms'], base_row):>9}"
+            f"{row['max_ms']:>10.1f}"
+            f"{row['first_p50_ms']:>13.1f}{delta('first_p50_ms', row['first_p50_ms'], base_row):>9}"
+            f"{row['errors']:>8}{row['degraded']:>9}"
+        )
+
+
+async def run_level(bot, users, args, photo_pool, offset):
+    tg = FakeTelegram(args.tg_latency)
+    crowd = [
+        VirtualUser(bot, tg, offset + n + 1, args.messages, args.seed + offset + n, photo_pool)
+        for n in range(users)
+    ]
+    started = time.perf_counter()
+    await asyncio.gather(*(user.run() for user in crowd))
+    elapsed = time.perf_counter() - started
+    result = summarize([t for user in crowd for t in user.timings], elapsed)
+    result["telegram_calls"] = tg.calls
+    return result
+
+
+async def main(args):
+    # Окружение бота задаётся до импорта: bot.py читает настройки при загрузке модуля
+    import fake_openai_server
+    from fake_sheets import FakeClient
+    os.environ["OPENAI_API_BASE"] = fake_openai_server.start_in_thread(
+        latency=args.openai_latency, error_rate=args.openai_error_rate)
+    os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="foodbot-load-")
+    for name, value in (
+        ("TOKEN", "0:load-test"), ("OPENAI_API_KEY", "sk-load-test"), ("LOG_LEVEL", "CRITICAL"),
+        ("STORAGE_BACKEND", "sheets"), ("SYNC_INTERVAL", "1"),
+        ("RATE_LIMIT_PER_MIN", "1000000"), ("RATE_LIMIT_BURST", "1000000"),
+    ):
+        os.environ.setdefault(name, value)
+    import bot
+    from storage import open_sheet_shards
+
+    # Ошибки Sheets включаем только на время замеров: подключение и финальная выгрузка — без них
+    client = FakeClient(args.sheets_latency)
+    if isinstance(bot.storage, bot.SheetsStorage):
+        bot.storage.connect = lambda: open_sheet_shards(
+            client, bot.SHARD_SPREADSHEETS, bot.SHEET_NAME, bot.SHEET_SHARDS, create=True)
+    await bot.storage.open()
+    if getattr(bot.storage, "task", None):
+        # ждём подключения к таблице, чтобы не мерить старт
+        await asyncio.wait_for(asyncio.shield(bot.storage.task), args.connect_timeout)
+
+    rnd = random.Random(args.seed)
+    photo_pool = [(f"photo{i}", make_photo(rnd)) for i in range(args.photos)]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    client.set_faults(error_rate=args.sheets_error_rate)
+    try:
+        for level, users in enumerate(args.users):
+            results[str(users)] = await run_level(bot, users, args, photo_pool, offset=level * 100000)
+            print_result(users, results[str(users)], baseline)
+    finally:
+        client.set_faults(error_rate=0.0)
+        await bot.storage.close()
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.save}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="*", default=[1, 10, 50], help="одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=20, help="текстовых сообщений на пользователя")
+    parser.add_argument("--photos", type=int, default=12, help="разных фото в пуле (остальные — повторы)")
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="средняя задержка OpenAI, сек")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="доля ответов 429/5xx")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="средняя задержка вызова Sheets API, сек")
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="средняя задержка вызова Bot API, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--connect-timeout", type=float, default=60, help="ожидание подключения к fake Sheets, сек")
+    parser.add_argument("--save", help="сохранить результаты в JSON (как базовую линию)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона: печатать изменения относительно него")
+    asyncio.run(main(parser.parse_args()))
@@ -1,20 +1,43 @@
 import logging
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import base64
+import json
+import math
+import asyncio
+import functools
+import hashlib
+import io
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import re
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from array import array
+
+_BOOT = time.perf_counter()  # отсчёт фаз холодного старта
 
-import gspread
-import matplotlib
-matplotlib.use("Agg")  # серверный backend
-import matplotlib.pyplot as plt
-import pandas as pd
 import openai
+import requests
+
+try:
+    from PIL import Image
+except ImportError:  # без Pillow фото уходит как есть, без пережатия
+    Image = None
 
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from aiohttp import web
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, CallbackQueryHandler, filters
 from telegram.request import HTTPXRequest
 
 # === SETTINGS (Render-ready) ===
-import os, http.server, socketserver, threading
+import os, hmac, signal, threading
+
+from food_db import FoodDatabase, parse_quantity
+from metrics import Registry, Tracer
+from storage import EventJournal, open_db, open_sheet_shards, shard_index
 
 from dotenv import load_dotenv
 load_dotenv()  # локально подтянет .env; на Render не мешает
@@ -24,232 +47,1827 @@ TOKEN = os.environ["TOKEN"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 SPREADSHEET_NAME = os.environ.get("SPREADSHEET_NAME", "FoodLog")
 SHEET_NAME = os.environ.get("SHEET_NAME", "log")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sheets")  # sheets | sqlite
+PENDING_BACKEND = os.environ.get("PENDING_BACKEND", "sqlite")  # sqlite | memory: где ждут подтверждения фото
+PENDING_TTL = float(os.environ.get("PENDING_TTL", "21600"))  # секунды до истечения неподтверждённого фото
+PENDING_MAX = int(os.environ.get("PENDING_MAX", "10000"))
+SHEET_SHARDS = int(os.environ.get("SHEET_SHARDS", "1"))  # >1: листы SHEET_NAME_0..SHEET_NAME_{N-1}
+# таблицы для шардов через запятую: шард i лежит в таблице i % len(...)
+SHARD_SPREADSHEETS = [name.strip() for name in os.environ.get("SHARD_SPREADSHEETS", SPREADSHEET_NAME).split(",")]
 PROXY_URL = os.environ.get("PROXY_URL", "")
+OPENAI_WORKERS = int(os.environ.get("OPENAI_WORKERS", "8"))
+SHEETS_WORKERS = int(os.environ.get("SHEETS_WORKERS", "2"))
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+DATA_DIR = os.environ.get("DATA_DIR", "/tmp")  # локальные SQLite-данные бота
+NUTRITION_CACHE_TTL_DAYS = float(os.environ.get("NUTRITION_CACHE_TTL_DAYS", "30"))
+NUTRITION_CACHE_MAX = int(os.environ.get("NUTRITION_CACHE_MAX", "5000"))
+# Локальная таблица продуктов (CSV, на 100 г); пустое значение — всё считает ChatGPT
+FOOD_DB_PATH = os.environ.get("FOOD_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "foods.csv"))
+FOOD_DB_MIN_SCORE = float(os.environ.get("FOOD_DB_MIN_SCORE", "0.8"))  # сходство названия 0..1 для ответа без ChatGPT
+SYNC_INTERVAL = float(os.environ.get("SYNC_INTERVAL", "5"))  # секунды между выгрузками в Sheets
+SYNC_BATCH = int(os.environ.get("SYNC_BATCH", "200"))  # строк за один append_rows
+BACKFILL_INTERVAL = float(os.environ.get("BACKFILL_INTERVAL", "60"))  # секунды между пачками досчёта; 0 — выкл.
+BACKFILL_BATCH = int(os.environ.get("BACKFILL_BATCH", "20"))  # записей без калорий за одну пачку
+BACKFILL_CONCURRENCY = int(os.environ.get("BACKFILL_CONCURRENCY", "2"))  # одновременных запросов к ChatGPT
+BACKFILL_MAX_ATTEMPTS = int(os.environ.get("BACKFILL_MAX_ATTEMPTS", "3"))
+SHEET_READ_CHUNK = int(os.environ.get("SHEET_READ_CHUNK", "5000"))  # строк за одно чтение листа при загрузке
+SHEET_FULL_RELOAD = os.environ.get("SHEET_FULL_RELOAD", "") == "1"  # "1" — при старте читать листы целиком
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "2"))
+REPORT_PROCESSES = int(os.environ.get("REPORT_PROCESSES", "0"))  # >0 — графики в пуле процессов такого размера
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") == "1"  # заглушка сразу, ответ ChatGPT — по мере генерации
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.0"))  # секунды между правками сообщения
+REPORT_CACHE_SIZE = int(os.environ.get("REPORT_CACHE_SIZE", "256"))
+PHOTO_TARGET_SIDE = int(os.environ.get("PHOTO_TARGET_SIDE", "768"))  # длинная сторона фото для Vision, px
+PHOTO_JPEG_QUALITY = int(os.environ.get("PHOTO_JPEG_QUALITY", "80"))
+PHOTO_DETAIL = os.environ.get("PHOTO_DETAIL", "low")  # low | high | auto
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "ERROR")
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "0"))  # >0: трассы апдейтов не быстрее N мс — в лог и /traces
+PORT = int(os.environ.get("PORT", "8080"))  # Render всегда задаёт PORT
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # публичный адрес сервиса, например https://foodbot.onrender.com
+BOT_MODE = os.environ.get("BOT_MODE", "webhook" if WEBHOOK_URL else "polling")  # webhook | polling
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+PHOTO_CACHE_MAX = int(os.environ.get("PHOTO_CACHE_MAX", "2000"))
+PHOTO_HASH_DISTANCE = int(os.environ.get("PHOTO_HASH_DISTANCE", "6"))  # макс. отличие в битах для «того же» фото
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", "")  # например, http://127.0.0.1:8081/v1 (fake_openai_server.py)
+LLM_FAKE = os.environ.get("LLM_FAKE", "")  # "1" — поднять локальный fake OpenAI-сервер и работать с ним
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "30"))  # таймаут одной попытки, сек
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "60"))  # общий дедлайн вызова с повторами, сек
+LLM_RETRIES = int(os.environ.get("LLM_RETRIES", "3"))
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+# одновременных запросов на модель, например "gpt-4o=4,gpt-3.5-turbo=8"; остальные модели — LLM_CONCURRENCY_DEFAULT
+LLM_CONCURRENCY = dict(
+    (model.strip(), int(limit)) for model, limit in
+    (pair.split("=") for pair in os.environ.get("LLM_CONCURRENCY", "gpt-4o=4,gpt-3.5-turbo=8").split(",") if pair.strip())
+)
+LLM_CONCURRENCY_DEFAULT = int(os.environ.get("LLM_CONCURRENCY_DEFAULT", "4"))
+LLM_QUEUE_PER_USER = int(os.environ.get("LLM_QUEUE_PER_USER", "3"))  # запросов пользователя в очереди модели
+LLM_QUEUE_MAX = int(os.environ.get("LLM_QUEUE_MAX", "200"))  # всего в очереди модели
+RATE_LIMIT_PER_MIN = float(os.environ.get("RATE_LIMIT_PER_MIN", "10"))  # токенов в минуту на пользователя
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "15"))
+RATE_LIMIT_PHOTO_COST = float(os.environ.get("RATE_LIMIT_PHOTO_COST", "3"))  # текст стоит 1 токен
 
 # Настройка OpenAI
 openai.api_key = OPENAI_API_KEY
 
 # GCP credentials: кладём JSON целиком в переменную и сохраняем во временный файл
-GCP_CREDENTIALS_JSON = os.environ["GCP_CREDENTIALS_JSON"]
+# при подключении к Google Sheets (нужны только бэкенду sheets)
+GCP_CREDENTIALS_JSON = os.environ.get("GCP_CREDENTIALS_JSON", "")
 GCP_CREDENTIALS_FILE = "/tmp/gcp_credentials.json"
-if not os.path.exists(GCP_CREDENTIALS_FILE):
-    with open(GCP_CREDENTIALS_FILE, "w") as f:
-        f.write(GCP_CREDENTIALS_JSON)
-
-# === Google Sheets ===
-gc = gspread.service_account(filename=GCP_CREDENTIALS_FILE)
-sh = gc.open(SPREADSHEET_NAME)
-worksheet = sh.worksheet(SHEET_NAME)
-
-# --- маленький HTTP-сервер для Render Web Service ---
-def _start_keepalive_server():
-    port = int(os.getenv("PORT", "8080"))  # Render всегда задаёт PORT
-    class _Handler(http.server.SimpleHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain; charset=utf-8")
-            self.end_headers()
-            self.wfile.write("✅ Bot is alive!".encode("utf-8"))
-        def log_message(self, format, *args):
-            return  # отключаем лишние логи
-
-    def _serve():
-        with socketserver.TCPServer(("", port), _Handler) as httpd:
-            print(f"Keepalive server listening on port {port}")
-            httpd.serve_forever()
-
-    threading.Thread(target=_serve, daemon=True).start()
 
 # === Логирование ===
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.ERROR)
+logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=LOG_LEVEL.upper())
 logger = logging.getLogger(__name__)
 
-# === Состояние подтверждений ===
-PENDING_CONFIRMATIONS = {}
+# === Фазы запуска: секунды от старта процесса, видны в /health ===
+STARTUP_TIMINGS = {}
+
+def mark_startup(phase):
+    STARTUP_TIMINGS[phase] = round(time.perf_counter() - _BOOT, 3)
+    logger.info(f"Старт: {phase} через {STARTUP_TIMINGS[phase]} с")
+
+mark_startup("imports")
+
+# === Метрики (/metrics) и трассировка апдейтов (/traces) ===
+metrics = Registry()
+OP_SECONDS = metrics.histogram("foodbot_op_seconds", "Длительность операций бота", ("op",))
+OP_ERRORS = metrics.counter("foodbot_op_errors_total", "Операции, завершившиеся исключением", ("op",))
+HANDLER_SECONDS = metrics.histogram("foodbot_handler_seconds", "Время обработки апдейта", ("handler",))
+HANDLER_ERRORS = metrics.counter("foodbot_handler_errors_total", "Апдейты, упавшие с исключением", ("handler",))
+LLM_QUEUE_SECONDS = metrics.histogram("foodbot_llm_queue_wait_seconds", "Ожидание слота модели", ("model",))
+LLM_REQUESTS = metrics.counter("foodbot_llm_requests_total", "Попытки запросов к OpenAI", ("model", "outcome"))
+LLM_TOKENS = metrics.counter("foodbot_llm_tokens_total", "Токены OpenAI", ("model", "kind"))
+LLM_CALL_TOKENS = metrics.histogram("foodbot_llm_call_tokens", "Токены на один запрос к OpenAI", ("purpose", "kind"),
+                                    buckets=(25, 50, 100, 200, 400, 800, 1600, 3200))
+tracer = Tracer(TRACE_SLOW_MS)
+
+@contextmanager
+def observe(op):
+    """
+    Замеряет блок: гистограмма foodbot_op_seconds, счётчик ошибок и шаг текущей трассы
+    """
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        OP_ERRORS.inc(op=op)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        OP_SECONDS.observe(seconds, op=op)
+        tracer.add_span(op, started, seconds, error)
+
+def timed(op):
+    """
+    Декоратор: observe(op) вокруг корутины или обычной функции
+    """
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with observe(op):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with observe(op):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def instrumented(handler):
+    """
+    Обёртка обработчика Telegram: время и ошибки по имени обработчика, трасса апдейта
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        with tracer.trace(f"{name}#{update.update_id}"):
+            try:
+                return await handler(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+    return wrapper
+
+# === Пулы для блокирующих вызовов ===
+# openai 0.28 и gspread синхронные: выполняем их в отдельных пулах потоков,
+# размер пула = лимит одновременных запросов к соответствующему сервису
+_EXECUTORS = {
+    "openai": ThreadPoolExecutor(max_workers=OPENAI_WORKERS, thread_name_prefix="openai"),
+    "sheets": ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets"),
+    "render": ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="render"),
+}
+
+def _warm_up_report_worker():
+    from reports import warm_up
+    warm_up()
+
+# Графики отчётов (pandas + matplotlib) держат GIL и в потоке тормозят остальные апдейты.
+# При REPORT_PROCESSES > 0 они строятся в пуле процессов "report". Воркеры создаются через fork
+# здесь, до открытия SQLite и запуска фоновых потоков, поэтому не наследуют ни соединений, ни
+# захваченных блокировок. В пул уходит reports.build_report_png, а не функции bot.py (их в
+# копии модуля у воркера ещё нет). Каждый воркер один раз импортирует matplotlib и прогревает шрифты
+if REPORT_PROCESSES > 0:
+    _EXECUTORS["report"] = ProcessPoolExecutor(
+        max_workers=REPORT_PROCESSES,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_warm_up_report_worker,
+    )
+    _EXECUTORS["report"].submit(int)  # запуск всех воркеров
+else:
+    _EXECUTORS["report"] = _EXECUTORS["render"]
+
+async def run_blocking(backend, func, *args, **kwargs):
+    """
+    Выполняет синхронный вызов в пуле backend-а, не блокируя event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTORS[backend], functools.partial(func, *args, **kwargs))
+
+# === Локальная БД (SQLite) ===
+DB_PATH = os.path.join(DATA_DIR, "foodbot.sqlite3")
+
+def _open_db():
+    """
+    Открывает соединение с локальной БД бота (WAL, можно использовать из пулов потоков)
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return open_db(DB_PATH)
+
+# === Ожидающие подтверждения: продукты с фото до «✅ Принять как есть» ===
+class ConfirmationStore:
+    """
+    Ожидающие подтверждения в памяти процесса. Ключ — (user_id, message_id сообщения
+    с кнопкой), поэтому у пользователя может ждать несколько фото. Запись живёт ttl секунд,
+    всего хранится не больше max_entries (вытесняются самые старые)
+    """
+    def __init__(self, ttl=21600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.users = {}  # user_id -> {message_id: (expires_at, detected)} в порядке добавления
+        self.order = OrderedDict()  # (user_id, message_id) -> expires_at, для вытеснения
+        self.evicted = 0
+
+    def put(self, user_id, message_id, detected):
+        user_id = str(user_id)
+        with self.lock:
+            self.order.pop((user_id, message_id), None)
+            self._drop(user_id, message_id)
+            expires_at = time.time() + self.ttl
+            self.users.setdefault(user_id, {})[message_id] = (expires_at, detected)
+            self.order[(user_id, message_id)] = expires_at
+            now = time.time()
+            while self.order and (len(self.order) > self.max_entries or next(iter(self.order.values())) <= now):
+                (old_user, old_message), _ = self.order.popitem(last=False)
+                self._drop(old_user, old_message)
+                self.evicted += 1
+
+    def pop(self, user_id, message_id=None):
+        """
+        Забирает продукты для сообщения message_id (или последнего фото пользователя).
+        None — ничего не ждёт или срок истёк
+        """
+        user_id = str(user_id)
+        with self.lock:
+            pending = self.users.get(user_id)
+            if not pending:
+                return None
+            if message_id is None:
+                message_id = next(reversed(pending))
+            self.order.pop((user_id, message_id), None)
+            entry = self._drop(user_id, message_id)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def _drop(self, user_id, message_id):
+        pending = self.users.get(user_id)
+        if pending is None:
+            return None
+        entry = pending.pop(message_id, None)
+        if not pending:
+            del self.users[user_id]
+        return entry
+
+    def stats(self):
+        return {"backend": "memory", "pending": len(self.order), "evicted": self.evicted}
+
+class SQLiteConfirmationStore(ConfirmationStore):
+    """
+    Ожидающие подтверждения в SQLite: переживают перезапуск и видны всем процессам бота
+    с общим DATA_DIR. Забирает запись тот, чей DELETE её удалил
+    """
+    def __init__(self, conn, ttl=21600, max_entries=10000):
+        super().__init__(ttl, max_entries)
+        self.conn = conn
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending_confirmations (
+                    user_id TEXT NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    detected TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, message_id)
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS pending_expires ON pending_confirmations(expires_at)"
+            )
+
+    def put(self, user_id, message_id, detected):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pending_confirmations VALUES (?, ?, ?, ?)",
+                (str(user_id), message_id, json.dumps(detected, ensure_ascii=False), now + self.ttl),
+            )
+            expired = self.conn.execute("DELETE FROM pending_confirmations WHERE expires_at <= ?", (now,)).rowcount
+            evicted = self.conn.execute(
+                "DELETE FROM pending_confirmations WHERE rowid IN ("
+                "SELECT rowid FROM pending_confirmations ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            self.evicted += expired + evicted
+
+    def pop(self, user_id, message_id=None):
+        now = time.time()
+        with self.lock, self.conn:
+            if message_id is None:
+                row = self.conn.execute(
+                    "SELECT message_id, detected FROM pending_confirmations "
+                    "WHERE user_id = ? AND expires_at > ? ORDER BY expires_at DESC LIMIT 1",
+                    (str(user_id), now),
+                ).fetchone()
+            else:
+                row = self.conn.execute(
+                    "SELECT message_id, detected FROM pending_confirmations "
+                    "WHERE user_id = ? AND message_id = ? AND expires_at > ?",
+                    (str(user_id), message_id, now),
+                ).fetchone()
+            if row is None:
+                return None
+            taken = self.conn.execute(
+                "DELETE FROM pending_confirmations WHERE user_id = ? AND message_id = ?",
+                (str(user_id), row["message_id"]),
+            ).rowcount
+        return json.loads(row["detected"]) if taken else None
+
+    def stats(self):
+        with self.lock:
+            pending = self.conn.execute("SELECT COUNT(*) FROM pending_confirmations").fetchone()[0]
+        return {"backend": "sqlite", "pending": pending, "evicted": self.evicted}
+
+if PENDING_BACKEND == "sqlite":
+    pending_confirmations = SQLiteConfirmationStore(_open_db(), PENDING_TTL, PENDING_MAX)
+else:
+    pending_confirmations = ConfirmationStore(PENDING_TTL, PENDING_MAX)
+
+# === Кэш пищевой ценности ===
+_GRAMS_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(?:г|гр|грамм|граммов|грамма|g)\b\.?", re.IGNORECASE)
+
+def normalize_query(query):
+    """
+    Нормализует текст запроса: регистр, ё/е, пробелы, пунктуация по краям
+    """
+    text = (query or "").lower().replace("ё", "е")
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" .,;!-")
+
+def split_quantity(query):
+    """
+    Отделяет вес в граммах от названия: "банан 150 г" -> ("банан", 150.0).
+    Если вес не указан (или указан несколько раз), возвращает (query, None)
+    """
+    matches = list(_GRAMS_RE.finditer(query))
+    if len(matches) != 1:
+        return query, None
+    m = matches[0]
+    base = normalize_query(query[:m.start()] + " " + query[m.end():])
+    return base, float(m.group(1).replace(",", "."))
+
+_FOOD_SEPARATORS_RE = re.compile(r"(?<!\d),|,(?!\d)|[;+\n]|\sи\s")  # «3,2%» — не разделитель
+
+def count_foods(text):
+    """
+    Сколько продуктов, скорее всего, в одной записи («овсянка 200г, кофе 250мл» — два)
+    """
+    return len([part for part in _FOOD_SEPARATORS_RE.split(text) if part.strip()]) or 1
+
+def _rescalable(query, base):
+    """
+    Пересчитать кэш под новый вес можно только для одного продукта без других количеств:
+    в «гречка 200г, кофе 250мл» вес относится к гречке, а в кэше — сумма по обоим
+    """
+    parsed = parse_quantity(base)
+    return count_foods(query) == 1 and parsed is not None and parsed[1] is None
+
+def _cache_key(query):
+    """
+    Канонический ключ кэша: "Банан 150г" и "банан 150 г" дают один ключ
+    """
+    base, grams = split_quantity(normalize_query(query))
+    key = f"{base} {grams:g} г" if grams is not None else base
+    return key, base, grams
+
+class NutritionCache:
+    """
+    Кэш ответов get_food_info в SQLite с TTL и вытеснением давно не использованных записей.
+    Если совпадает только название продукта, значения пересчитываются под новый вес
+    """
+    FIELDS = ("calories", "protein", "fat", "carbs")
+
+    def __init__(self, conn, ttl_days=30, max_entries=5000):
+        self.conn = conn
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.rescaled = 0
+        self.misses = 0
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS nutrition_cache (
+                    query TEXT PRIMARY KEY,
+                    base TEXT NOT NULL,
+                    name TEXT, grams REAL, calories REAL, protein REAL, fat REAL, carbs REAL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS nutrition_cache_base ON nutrition_cache(base)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS nutrition_cache_lru ON nutrition_cache(last_used)")
+
+    @staticmethod
+    def _to_info(row, grams=None):
+        info = {
+            "name": row["name"],
+            "grams": row["grams"],
+            "calories": row["calories"],
+            "protein": row["protein"],
+            "fat": row["fat"],
+            "carbs": row["carbs"],
+        }
+        if grams is not None and row["grams"]:
+            k = grams / row["grams"]
+            info["grams"] = grams
+            for field in NutritionCache.FIELDS:
+                info[field] = round(info[field] * k, 1)
+        return info
+
+    def get(self, query):
+        key, base, grams = _cache_key(query)
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT * FROM nutrition_cache WHERE query = ? AND created_at >= ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            rescale = False
+            if row is None and grams is not None and _rescalable(normalize_query(query), base):
+                row = self.conn.execute(
+                    "SELECT * FROM nutrition_cache WHERE base = ? AND grams > 0 AND created_at >= ? "
+                    "ORDER BY last_used DESC LIMIT 1",
+                    (base, now - self.ttl),
+                ).fetchone()
+                rescale = row is not None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE nutrition_cache SET last_used = ? WHERE query = ?", (now, row["query"]))
+            self.hits += 1
+            if rescale:
+                self.rescaled += 1
+                return self._to_info(row, grams)
+            return self._to_info(row)
+
+    def put(self, query, info):
+        key, base, _ = _cache_key(query)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO nutrition_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, base, info["name"], info["grams"], info["calories"], info["protein"],
+                 info["fat"], info["carbs"], now, now),
+            )
+            self.conn.execute("DELETE FROM nutrition_cache WHERE created_at < ?", (now - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM nutrition_cache WHERE query IN ("
+                "SELECT query FROM nutrition_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "rescaled": self.rescaled,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+nutrition_cache = NutritionCache(_open_db(), NUTRITION_CACHE_TTL_DAYS, NUTRITION_CACHE_MAX)
+
+# === Локальная таблица продуктов ===
+food_db = FoodDatabase.from_csv(FOOD_DB_PATH, FOOD_DB_MIN_SCORE) if FOOD_DB_PATH else None
+
+def lookup_known(query):
+    """
+    Пищевая ценность без ChatGPT: уверенное совпадение в таблице продуктов, иначе кэш ответов
+    """
+    info = food_db.lookup(query) if food_db else None
+    return info or nutrition_cache.get(query)
+
+# === LLM-клиент: пул соединений, таймауты, повторы, circuit breaker ===
+if LLM_FAKE:
+    import fake_openai_server
+    OPENAI_API_BASE = fake_openai_server.start_in_thread()
+if OPENAI_API_BASE:
+    openai.api_base = OPENAI_API_BASE
+
+class _SharedSession(requests.Session):
+    """
+    Сессия, общая для всех потоков пула "openai". openai 0.28 раз в 180 с закрывает сессию
+    своего потока (MAX_SESSION_LIFETIME_SECS), а у общей сессии это рвало бы keep-alive
+    соединения, которыми в тот же момент пользуются другие потоки. Поэтому close() ничего не делает
+    """
+    def close(self):
+        pass
+
+# Один пул keep-alive соединений на все потоки пула "openai"
+_llm_session = _SharedSession()
+_llm_adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=OPENAI_WORKERS, max_retries=0)
+_llm_session.mount("https://", _llm_adapter)
+_llm_session.mount("http://", _llm_adapter)
+openai.requestssession = _llm_session
+
+class LLMUnavailableError(Exception):
+    """
+    OpenAI недоступен: открыт circuit breaker или исчерпаны повторы/дедлайн
+    """
+
+class CircuitBreaker:
+    """
+    После failure_threshold подряд неудачных попыток размыкается на cooldown секунд
+    и отвечает отказом сразу; затем пропускает один пробный запрос
+    """
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """
+        Пробный запрос закончился без вывода о здоровье OpenAI (отмена, ошибка в нашем коде):
+        следующий вызов снова может стать пробным
+        """
+        self.probing = False
+
+llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN)
+
+# === Лимиты пользователей и справедливая очередь к моделям ===
+class LLMBusyError(LLMUnavailableError):
+    """
+    Очередь к модели переполнена (всего или у этого пользователя)
+    """
+
+class UserRateLimiter:
+    """
+    Token bucket на пользователя: rate токенов в минуту, не больше burst про запас
+    """
+    def __init__(self, rate_per_min=10.0, burst=15.0, max_users=100000):
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = {}  # user_id -> (токены, время обновления)
+        self.limited = 0
+
+    def take(self, user_id, cost=1.0):
+        """
+        Списывает cost токенов; возвращает 0, если можно, иначе сколько секунд подождать
+        """
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < cost:
+            self.buckets[user_id] = (tokens, now)
+            self.limited += 1
+            return (cost - tokens) / self.rate
+        self.buckets[user_id] = (tokens - cost, now)
+        if len(self.buckets) > self.max_users:
+            # полные вёдра ничем не отличаются от отсутствующих
+            full = now - self.burst / self.rate
+            self.buckets = {user: b for user, b in self.buckets.items() if b[1] > full}
+        return 0
+
+    def stats(self):
+        return {"users": len(self.buckets), "limited": self.limited}
+
+class _Lane:
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = 0
+        self.queues = OrderedDict()  # user_id -> deque ожидающих future, порядок — очередь обхода
+        self.granted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+class FairScheduler:
+    """
+    Лимит одновременных запросов на модель и справедливая очередь: освободившийся слот
+    получает следующий по кругу пользователь (round-robin), а не следующий запрос,
+    поэтому один активный пользователь не вытесняет остальных. Очереди из background
+    (фоновые задачи) получают слот, только когда ни один пользователь его не ждёт
+    """
+    def __init__(self, limits, default_limit=4, max_queue_per_user=3, max_queue=200, background=()):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue = max_queue
+        self.background = frozenset(background)
+        self.lanes = {}
+
+    def _lane(self, model):
+        if model not in self.lanes:
+            self.lanes[model] = _Lane(self.limits.get(model, self.default_limit))
+        return self.lanes[model]
+
+    async def acquire(self, model, user_id):
+        lane = self._lane(model)
+        started = time.monotonic()
+        if lane.running < lane.limit and not lane.waiting:
+            lane.running += 1
+        else:
+            queue = lane.queues.get(user_id)
+            if lane.waiting >= self.max_queue or (queue and len(queue) >= self.max_queue_per_user):
+                lane.rejected += 1
+                raise LLMBusyError(f"очередь к {model} переполнена")
+            future = asyncio.get_running_loop().create_future()
+            lane.queues.setdefault(user_id, deque()).append(future)
+            lane.waiting += 1
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release(model)  # слот уже передан нам — возвращаем
+                else:
+                    self._forget(lane, user_id, future)
+                raise
+        waited = time.monotonic() - started
+        lane.granted += 1
+        lane.wait_total += waited
+        lane.wait_max = max(lane.wait_max, waited)
+
+    def release(self, model):
+        lane = self._lane(model)
+        while lane.queues:
+            user_id = next((u for u in lane.queues if u not in self.background), None)
+            if user_id is None:
+                user_id = next(iter(lane.queues))
+            queue = lane.queues[user_id]
+            future = queue.popleft()
+            if queue:
+                lane.queues.move_to_end(user_id)
+            else:
+                del lane.queues[user_id]
+            lane.waiting -= 1
+            if not future.done():
+                future.set_result(None)  # слот переходит ожидающему, running не меняется
+                return
+        lane.running -= 1
+
+    @staticmethod
+    def _forget(lane, user_id, future):
+        queue = lane.queues.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            lane.waiting -= 1
+            if not queue:
+                del lane.queues[user_id]
+
+    def stats(self):
+        return {
+            model: {
+                "running": lane.running, "limit": lane.limit, "queued": lane.waiting,
+                "queued_users": len(lane.queues), "rejected": lane.rejected,
+                "wait_avg": round(lane.wait_total / lane.granted, 3) if lane.granted else 0.0,
+                "wait_max": round(lane.wait_max, 3),
+            }
+            for model, lane in self.lanes.items()
+        }
+
+rate_limiter = UserRateLimiter(RATE_LIMIT_PER_MIN, RATE_LIMIT_BURST)
+BACKFILL_USER = "backfill"  # очередь фонового досчёта калорий в llm_scheduler
+llm_scheduler = FairScheduler(
+    LLM_CONCURRENCY, LLM_CONCURRENCY_DEFAULT, LLM_QUEUE_PER_USER, LLM_QUEUE_MAX, background=(BACKFILL_USER,),
+)
+
+_LLM_RETRYABLE = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    asyncio.TimeoutError,
+)
+
+def _is_retryable(error):
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(error, _LLM_RETRYABLE)
+
+async def llm_chat(user_id=None, on_delta=None, purpose="chat", **kwargs):
+    """
+    ChatCompletion.create в очереди модели (справедливо по user_id) с таймаутом попытки,
+    общим дедлайном, повторами с джиттером на 429/5xx/сетевых ошибках и circuit breaker'ом.
+    on_delta(текст) — потоковый режим: вызывается в event loop с накопленным текстом ответа
+    по мере генерации; результат тот же, что без потока.
+    Токены ответа учитываются по вызову (purpose) и по пользователю в llm_usage
+    """
+    model = kwargs.get("model")
+    started = time.perf_counter()
+    await llm_scheduler.acquire(model, user_id)
+    LLM_QUEUE_SECONDS.observe(time.perf_counter() - started, model=model)
+    tracer.add_span(f"queue:{model}", started, time.perf_counter() - started)
+    try:
+        with observe(f"llm:{model}"):  # с повторами, без ожидания в очереди
+            called = time.perf_counter()
+            response = await _llm_chat(on_delta, **kwargs)
+    finally:
+        llm_scheduler.release(model)
+    llm_usage.record(user_id, purpose, model, response.get("usage") or {}, time.perf_counter() - called)
+    return response
+
+async def _llm_chat(on_delta=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LLM_DEADLINE
+    current = None
+    for attempt in range(LLM_RETRIES + 1):
+        if not llm_breaker.allow():
+            LLM_REQUESTS.inc(model=kwargs.get("model"), outcome="breaker_open")
+            raise LLMUnavailableError("OpenAI временно недоступен (circuit breaker открыт)")
+        probe = llm_breaker.probing  # allow() пропустил нас пробным запросом
+        timeout = min(LLM_TIMEOUT, deadline - loop.time())
+        create = openai.ChatCompletion.create
+        if on_delta is not None:
+            # куски из потока брошенной (по таймауту) попытки больше не показываем
+            current = attempt
+
+            def emit(text, attempt=attempt):
+                if current == attempt:
+                    on_delta(text)
+            create = functools.partial(_stream_completion, lambda text: loop.call_soon_threadsafe(emit, text))
+        try:
+            response = await asyncio.wait_for(
+                run_blocking("openai", create, request_timeout=timeout, **kwargs),
+                timeout=timeout + 1,
+            )
+        except Exception as e:
+            if not _is_retryable(e):
+                LLM_REQUESTS.inc(model=kwargs.get("model"), outcome="error")
+                if getattr(e, "http_status", None) is not None:
+                    llm_breaker.record_success()  # OpenAI ответил (4xx на наш запрос) — он жив
+                raise
+            LLM_REQUESTS.inc(model=kwargs.get("model"), outcome="retryable_error")
+            llm_breaker.record_failure()
+            # full jitter: 0..min(8, 0.5 * 2^attempt) секунд
+            delay = random.uniform(0, min(8.0, 0.5 * 2 ** attempt))
+            if attempt == LLM_RETRIES or loop.time() + delay >= deadline:
+                raise LLMUnavailableError(f"OpenAI не ответил: {e}") from e
+            logger.warning(f"OpenAI: {e}, повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            if probe:
+                llm_breaker.release_probe()  # отмена или чужая ошибка: не успех и не отказ
+        llm_breaker.record_success()
+        LLM_REQUESTS.inc(model=kwargs.get("model"), outcome="ok")
+        usage = response.get("usage") or {}
+        for kind in ("prompt_tokens", "completion_tokens"):
+            LLM_TOKENS.inc(usage.get(kind, 0), model=kwargs.get("model"), kind=kind.split("_")[0])
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        LLM_TOKENS.inc(cached, model=kwargs.get("model"), kind="cached")
+        return response
 
+def _stream_completion(emit, **kwargs):
+    """
+    ChatCompletion.create(stream=True) в потоке пула: emit(накопленный текст) на каждом куске.
+    Возвращает ответ той же формы, что без потока (choices[0].message.content и usage)
+    """
+    parts = []
+    usage = {}
+    for chunk in openai.ChatCompletion.create(stream=True, stream_options={"include_usage": True}, **kwargs):
+        usage = chunk.get("usage") or usage
+        choices = chunk.get("choices") or []
+        delta = choices[0].get("delta", {}).get("content") if choices else None
+        if delta:
+            parts.append(delta)
+            emit("".join(parts))
+    return openai.openai_object.OpenAIObject.construct_from({
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)}, "finish_reason": "stop"}],
+        "usage": usage,
+    })
+
+# === Учёт токенов OpenAI: по вызову и по пользователю ===
+class LLMUsage:
+    """
+    Токены запросов к OpenAI в SQLite по дням: (день, пользователь, назначение, модель) ->
+    число вызовов, токены запроса (из них взятые из кэша промптов OpenAI) и ответа.
+    Каждый вызов также попадает в гистограмму foodbot_llm_call_tokens и в лог
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_usage (
+                    day TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    purpose TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    calls INTEGER NOT NULL DEFAULT 0,
+                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    cached_tokens INTEGER NOT NULL DEFAULT 0,
+                    completion_tokens INTEGER NOT NULL DEFAULT 0,
+                    seconds REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, user_id, purpose, model)
+                )
+            """)
+
+    def record(self, user_id, purpose, model, usage, seconds=0.0):
+        prompt = int(usage.get("prompt_tokens") or 0)
+        completion = int(usage.get("completion_tokens") or 0)
+        cached = int((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0)
+        LLM_CALL_TOKENS.observe(prompt, purpose=purpose, kind="prompt")
+        LLM_CALL_TOKENS.observe(completion, purpose=purpose, kind="completion")
+        logger.info(
+            f"OpenAI {purpose} ({model}): {seconds:.2f} с, токены prompt={prompt} "
+            f"(из кэша {cached}) completion={completion}, пользователь {user_id}"
+        )
+        key = (date.today().isoformat(), str(user_id), purpose, model)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO llm_usage (day, user_id, purpose, model) VALUES (?, ?, ?, ?)", key)
+            self.conn.execute(
+                "UPDATE llm_usage SET calls = calls + 1, prompt_tokens = prompt_tokens + ?, "
+                "cached_tokens = cached_tokens + ?, completion_tokens = completion_tokens + ?, seconds = seconds + ? "
+                "WHERE day = ? AND user_id = ? AND purpose = ? AND model = ?",
+                (prompt, cached, completion, seconds) + key,
+            )
+
+    def by_purpose(self, day=None):
+        """
+        Итоги за день по назначению: {purpose: {calls, prompt, cached, completion, avg_seconds}}
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT purpose, SUM(calls), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), SUM(seconds) "
+                "FROM llm_usage WHERE day = ? GROUP BY purpose",
+                ((day or date.today()).isoformat(),),
+            ).fetchall()
+        return {
+            purpose: {"calls": calls, "prompt": prompt, "cached": cached, "completion": completion,
+                      "avg_seconds": round(seconds / calls, 2) if calls else 0.0}
+            for purpose, calls, prompt, cached, completion, seconds in rows
+        }
+
+    def top_users(self, day=None, limit=5):
+        """
+        Пользователи с наибольшим расходом токенов за день: [(user_id, calls, токенов всего)]
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT user_id, SUM(calls), SUM(prompt_tokens + completion_tokens) AS tokens FROM llm_usage "
+                "WHERE day = ? GROUP BY user_id ORDER BY tokens DESC LIMIT ?",
+                ((day or date.today()).isoformat(), limit),
+            ).fetchall()
+        return [tuple(row) for row in rows]
 
+llm_usage = LLMUsage(_open_db())
+
+# === Склейка одинаковых запросов (single-flight) ===
+class SingleFlight:
+    """
+    Одновременные вызовы с одинаковым ключом ждут одну общую задачу, а не запускают свою.
+    Ошибка достаётся всем ожидающим и не запоминается: следующий вызов начнёт заново.
+    keep > 0 — непустой результат ещё keep секунд отдаётся запоздавшим дублям (для кнопок)
+    """
+    def __init__(self, name, keep=0.0, max_kept=10000):
+        self.name = name
+        self.keep = keep
+        self.max_kept = max_kept
+        self.inflight = {}  # ключ -> asyncio.Task
+        self.kept = OrderedDict()  # ключ -> (expires_at, результат)
+        self.started = 0
+        self.joined = 0
+
+    async def do(self, key, factory):
+        """
+        Результат factory() для key; отмена одного ожидающего не отменяет общую задачу
+        """
+        now = time.monotonic()
+        while self.kept and next(iter(self.kept.values()))[0] <= now:
+            self.kept.popitem(last=False)
+        if key in self.kept:
+            self.joined += 1
+            return self.kept[key][1]
+        task = self.inflight.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.get_running_loop().create_task(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.keep <= 0 or not task.result():
+            return
+        self.kept[key] = (time.monotonic() + self.keep, task.result())
+        while len(self.kept) > self.max_kept:
+            self.kept.popitem(last=False)
+
+    def stats(self):
+        return {"started": self.started, "joined": self.joined, "inflight": len(self.inflight)}
+
+food_info_flight = SingleFlight("food_info")
+food_items_flight = SingleFlight("food_items")
+photo_flight = SingleFlight("photo")
+accept_flight = SingleFlight("accept_photo", keep=300.0)  # запоздавшие повторные нажатия «Принять»
+FLIGHTS = (food_info_flight, food_items_flight, photo_flight, accept_flight)
+
+# === Постепенные ответы: заглушка и правки по мере генерации ===
+class ProgressiveReply:
+    """
+    Ответ пользователю, который показывается до готовности результата: start() сразу отправляет
+    заглушку, feed(текст) правит её по мере ответа ChatGPT (не чаще раза в interval секунд,
+    чтобы не упереться в лимиты Telegram), finish(текст) ставит итог. Если start() не вызывали
+    (ответ из кэша) или стриминг выключен, finish() просто отправляет сообщение
+    """
+    def __init__(self, send, placeholder, render=None, enabled=STREAM_REPLIES, interval=STREAM_EDIT_INTERVAL):
+        self.send = send
+        self.placeholder = placeholder
+        self.render = render  # накопленный текст ответа -> текст сообщения или None
+        self.enabled = enabled
+        self.interval = interval
+        self.sending = None  # задача отправки заглушки
+        self.shown = placeholder
+        self.latest = None
+        self.editing = None
+        self.edited_at = 0.0
+
+    @property
+    def on_delta(self):
+        """
+        Колбэк для llm_chat или None, если постепенный показ не нужен
+        """
+        return self.feed if self.enabled and self.render else None
+
+    def start(self):
+        if self.enabled and self.sending is None:
+            self.sending = asyncio.get_running_loop().create_task(self.send(self.placeholder))
+
+    def feed(self, text):
+        if self.sending is None:
+            return
+        try:
+            shown = self.render(text)
+        except Exception:
+            return
+        if not shown or shown == self.latest:
+            return
+        self.latest = shown
+        if self.editing is None:
+            self.editing = asyncio.get_running_loop().create_task(self._edit_later())
+
+    async def _edit_later(self):
+        try:
+            message = await self.sending
+            await asyncio.sleep(max(0.0, self.edited_at + self.interval - time.monotonic()))
+            if self.latest != self.shown:
+                self.shown = self.latest
+                self.edited_at = time.monotonic()
+                await message.edit_text(self.shown)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"Не удалось обновить сообщение: {e}")
+        finally:
+            self.editing = None
+
+    async def finish(self, text, **kwargs):
+        """
+        Итоговый текст: правка заглушки или новое сообщение. Возвращает сообщение
+        """
+        if self.editing is not None:
+            self.editing.cancel()
+            await asyncio.wait([self.editing])  # прерванная правка не должна прийти после итога
+        if self.sending is not None:
+            try:
+                message = await self.sending
+            except Exception as e:
+                logger.warning(f"Заглушка не отправлена: {e}")
+            else:
+                self.sending = None
+                return await message.edit_text(text, **kwargs)
+        return await self.send(text, **kwargs)
 
 # === ChatGPT API ===
-def get_food_info(query):
+# Правила и схема ответа — в коротком неизменном системном промпте, в пользовательском
+# сообщении — только сами продукты. Ответ — JSON-объект (response_format)
+# с короткими ключами: {"items": [...]} и для текста, и для фото
+NUTRITION_PROMPT = (
+    "Ты эксперт по питанию. Каждая строка сообщения — запись о еде: один или несколько продуктов, "
+    "возможно с количеством. "
+    'Ответь JSON-объектом {"items":[{"name":str,"grams":num,"kcal":num,"p":num,"f":num,"c":num}]}: '
+    "ровно один объект на строку в том же порядке, несколько продуктов в строке — один объект "
+    "с суммой; name — название по-русски; grams — указанное количество в граммах, без количества — "
+    "стандартная порция (обычно 100); kcal — калории, p, f, c — белки, жиры, углеводы в граммах "
+    "на эту порцию."
+)
+PHOTO_PROMPT = (
+    "Ты распознаёшь еду на фото. Ответь JSON-объектом "
+    '{"items":[{"name":str,"amount":str}]}: до 6 съедобных продуктов, name — по-русски, amount — '
+    '"1 шт", "150 г", "200 мл", "1 стакан", "1 тарелка"; если количество не оценить — "1 порция". '
+    "Посуду и несъедобное не указывай; нет еды — пустой items."
+)
+JSON_RESPONSE = {"type": "json_object"}
+_NUTRITION_KEYS = {"grams": "grams", "kcal": "calories", "p": "protein", "f": "fat", "c": "carbs"}
+
+def _amount(value):
     """
-    Получает информацию о продукте через ChatGPT API
+    Неотрицательное конечное число из JSON, иначе ValueError (строки и bool не принимаются)
     """
-    prompt = f"""
-    Проанализируй следующий продукт питания и верни точную информацию о его пищевой ценности.
-    
-    Продукт: {query}
-    
-    Верни ответ в строго определённом JSON формате:
-    {{
-        "name": "название продукта",
-        "grams": число_граммов,
-        "calories": число_калорий,
-        "protein": число_граммов_белков,
-        "fat": число_граммов_жиров,
-        "carbs": число_граммов_углеводов
-    }}
-    
-    Важные правила:
-    1. Если в запросе указано количество (например "150 г банана"), используй это количество
-    2. Если количество не указано, используй стандартную порцию (обычно 100 г)
-    3. Все числовые значения должны быть float
-    4. Название продукта должно быть на русском языке
-    5. Верни ТОЛЬКО JSON, без дополнительного текста
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+        raise ValueError(f"некорректное число: {value!r}")
+    return float(value)
+
+def parse_items(content, count=None):
     """
-    
+    Строгий разбор ответа: JSON-объект с массивом items из объектов (при count — ровно count).
+    Нарушение формата — ValueError
+    """
+    data = json.loads(content)
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ValueError("ожидался объект {\"items\": [{...}]}")
+    if count is not None and len(items) != count:
+        raise ValueError(f"ожидалось {count} продуктов, получено {len(items)}")
+    return items
+
+def merge_nutrition(infos):
+    """
+    Несколько food_info одной записи -> один с суммой; None, если какой-то не разобран
+    """
+    if not infos or any(info is None for info in infos):
+        return None
+    return {
+        "name": ", ".join(info["name"] for info in infos),
+        **{field: round(sum(info[field] for info in infos), 1) for field in _NUTRITION_KEYS.values()},
+    }
+
+def parse_nutrition(item):
+    """
+    Объект из items -> food_info или None, если поля не того типа
+    """
+    name = item.get("name")
+    if not isinstance(name, str) or not name.strip():
+        return None
+    try:
+        info = {field: _amount(item.get(key)) for key, field in _NUTRITION_KEYS.items()}
+    except ValueError:
+        return None
+    return {"name": name.strip(), **info}
+
+@timed("food_info")
+async def get_food_info(query, user_id=None, progress=None):
+    """
+    Получает информацию о продукте: из таблицы продуктов или кэша, иначе через ChatGPT API.
+    progress (ProgressiveReply) показывает заглушку, только если нужен запрос к ChatGPT
+    """
+    known = lookup_known(query)
+    if known:
+        return known
+    if progress is not None:
+        progress.start()
+
+    async def ask():
+        food_info = await _ask_food_info(query, user_id, progress.on_delta if progress else None)
+        if food_info:
+            nutrition_cache.put(query, food_info)
+        return food_info
+
+    # одинаковые запросы разных пользователей в один момент — один вызов ChatGPT
+    return await food_info_flight.do(_cache_key(query)[0], ask)
+
+_JSON_STRING_RE = r'"{}"\s*:\s*"((?:[^"\\]|\\.)*)"'
+
+def food_info_progress(text):
+    """
+    Промежуточный текст по началу JSON-ответа ChatGPT: название продукта, как только оно пришло
+    """
+    m = re.search(_JSON_STRING_RE.format("name"), text)
+    return f"🧮 {m.group(1).title()}: считаю калории…" if m and m.group(1) else None
+
+async def _ask_food_info(query, user_id=None, on_delta=None):
+    """
+    Запрашивает пищевую ценность продукта у ChatGPT API
+    """
+    content = None
     try:
-        response = openai.ChatCompletion.create(
+        response = await llm_chat(
+            user_id=user_id,
+            on_delta=on_delta,
+            purpose="food_info",
             model="gpt-3.5-turbo",
             messages=[
-                {"role": "system", "content": "Ты эксперт по питанию и пищевой ценности продуктов. Твоя задача - точно определить калории, белки, жиры, углеводы и вес продуктов."},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": NUTRITION_PROMPT},
+                {"role": "user", "content": " ".join(query.split())}
             ],
+            response_format=JSON_RESPONSE,
             temperature=0.1,
-            max_tokens=200
+            max_tokens=50 * count_foods(query) + 30
         )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # Извлекаем JSON из ответа
-        import json
-        try:
-            # Пытаемся найти JSON в ответе
-            start_idx = content.find('{')
-            end_idx = content.rfind('}') + 1
-            if start_idx != -1 and end_idx != 0:
-                json_str = content[start_idx:end_idx]
-                data = json.loads(json_str)
-                
-                return {
-                    "name": data.get("name", ""),
-                    "grams": float(data.get("grams", 0)),
-                    "calories": float(data.get("calories", 0)),
-                    "protein": float(data.get("protein", 0)),
-                    "fat": float(data.get("fat", 0)),
-                    "carbs": float(data.get("carbs", 0))
-                }
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка парсинга JSON: {e}, ответ: {content}")
-            return None
-            
+        content = response.choices[0].message.content
+        # модель может вернуть запись из нескольких продуктов объектом на каждый — складываем
+        return merge_nutrition([parse_nutrition(item) for item in parse_items(content)])
+    except LLMUnavailableError:
+        raise
+    except ValueError as e:  # в т.ч. json.JSONDecodeError
+        logger.error(f"Некорректный ответ ChatGPT: {e}, ответ: {content}")
+        return None
     except Exception as e:
         logger.error(f"ChatGPT запрос упал: {e}")
         return None
-    
-    return None
 
-def safe_float(value):
+# === Пакетный расчёт для нескольких продуктов ===
+NUTRIENT_FIELDS = ("grams", "calories", "protein", "fat", "carbs")
+
+@timed("food_items")
+async def resolve_food_items(items, user_id=None, strict=False):
+    """
+    Считает пищевую ценность каждого продукта из списка (например, распознанного на фото).
+    Известные продукты берутся из таблицы продуктов и кэша, остальные — одним запросом к ChatGPT.
+    strict=True — недоступность ChatGPT пробрасывается (LLMUnavailableError), а не считается «не найдено».
+    Возвращает ([(продукт, food_info или None), ...], итог по найденным)
+    """
+    resolved = {item: lookup_known(item) for item in items}
+    unknown = [item for item in items if resolved[item] is None]
+    if unknown:
+        key = (tuple(_cache_key(item)[0] for item in unknown), strict)
+        answers = await food_items_flight.do(key, lambda: _ask_food_items(unknown, user_id, strict))
+        for item, food_info in zip(unknown, answers):
+            if food_info:
+                nutrition_cache.put(item, food_info)
+                resolved[item] = food_info
+
+    rows = [(item, resolved[item]) for item in items]
+    total = {field: sum(info[field] for _, info in rows if info) for field in NUTRIENT_FIELDS}
+    return rows, total
+
+async def _ask_food_items(items, user_id=None, strict=False):
+    """
+    Запрашивает у ChatGPT пищевую ценность нескольких продуктов сразу.
+    Возвращает список той же длины, что items (None для нераспознанных)
+    """
+    content = None
+    try:
+        response = await llm_chat(
+            user_id=user_id,
+            purpose="food_items",
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": NUTRITION_PROMPT},
+                {"role": "user", "content": "\n".join(" ".join(item.split()) for item in items)}
+            ],
+            response_format=JSON_RESPONSE,
+            temperature=0.1,
+            max_tokens=50 * sum(count_foods(item) for item in items) + 20
+        )
+        content = response.choices[0].message.content
+        return [parse_nutrition(entry) for entry in parse_items(content, len(items))]
+    except Exception as e:
+        if strict and isinstance(e, LLMUnavailableError):
+            raise
+        if isinstance(e, ValueError):
+            logger.error(f"Некорректный ответ ChatGPT на пакетный запрос: {e}, ответ: {content}")
+        else:
+            logger.error(f"ChatGPT пакетный запрос упал: {e}")
+        return [None] * len(items)
+
+def format_food_items(rows, total):
+    """
+    Текст ответа по нескольким продуктам: строка на продукт и итог
+    """
+    lines = []
+    for item, food_info in rows:
+        if food_info:
+            lines.append(
+                f"🍽 {food_info['name'].title()} — {food_info['grams']:.0f}г, {food_info['calories']:.0f}ккал, "
+                f"Б{food_info['protein']:.1f} Ж{food_info['fat']:.1f} У{food_info['carbs']:.1f}"
+            )
+        else:
+            lines.append(f"❔ {item} — калории не найдены")
+    lines.append(
+        f"\nИтого: ⚖️ {total['grams']:.0f}г 🔥 {total['calories']:.0f}ккал "
+        f"💪 Б{total['protein']:.1f}г 🥑 Ж{total['fat']:.1f}г 🍞 У{total['carbs']:.1f}г"
+    )
+    lines.append("✅ Записано в журнал!")
+    return "\n".join(lines)
+
+# === Журнал записей (локально) + синхронизация с Google Sheets ===
+journal = EventJournal(_open_db())
+
+class StaleSheetMark(Exception):
+    """
+    Отмеченная строка листа сдвинулась (лист правили вручную) — нужна полная перезагрузка
+    """
+
+class SheetSyncer:
+    """
+    Фоновая выгрузка журнала в листы Google Sheets пачками через append_rows.
+    Запись уходит в шард своего пользователя; entry_id в колонке K защищает от дублей
+    при повторах и перезапусках
+    """
+    def __init__(self, journal, shards, interval=5.0, batch=200, max_backoff=300.0, chunk_rows=5000,
+                 full_reload=False):
+        self.journal = journal
+        self.shards = shards
+        self.interval = interval
+        self.batch = batch
+        self.max_backoff = max_backoff
+        self.chunk_rows = chunk_rows
+        self.full_reload = full_reload
+        self.lock = threading.Lock()  # выгрузка и удаление строк в таблице не должны пересекаться
+        self.failures = 0
+        self.task = None
+
+    def _by_shard(self, items, user_of):
+        grouped = {}
+        for item in items:
+            grouped.setdefault(shard_index(user_of(item), len(self.shards)), []).append(item)
+        return [(self.shards[i], group) for i, group in sorted(grouped.items())]
+
+    def reload(self):
+        """
+        Стартовая загрузка журнала из шардов окнами по chunk_rows строк. Если журнал уже загружался,
+        дочитываются только строки после высшей отметки каждого листа; иначе (или если отметка
+        не совпала с листом) листы читаются целиком. Возвращает число прочитанных записей
+        """
+        with self.lock:
+            marks = [self.journal.sheet_mark(shard.title) for shard in self.shards]
+            if self.full_reload or None in marks:
+                return self._import(None)
+            try:
+                return self._import(marks)
+            except StaleSheetMark as e:
+                logger.warning(f"Отметка листа {e} устарела, загружаем листы целиком")
+                return self._import(None)
+
+    def _import(self, marks):
+        """
+        Читает шарды окнами в промежуточную таблицу журнала и применяет их одной транзакцией.
+        marks=None — полная загрузка
+        """
+        self.journal.start_import()
+        new_marks = []
+        for shard, mark in zip(self.shards, marks or [None] * len(self.shards)):
+            last = mark
+            windows = shard.iter_entries(mark[0] if mark else 2, self.chunk_rows)
+            while True:
+                with observe("sheet_read"):
+                    window = next(windows, None)
+                if window is None:
+                    break
+                first_row, ids, entries = window
+                if mark and first_row == mark[0] and ids[0] != mark[1]:
+                    raise StaleSheetMark(shard.title)
+                self.journal.stage_import(entries)
+                last = (first_row + len(ids) - 1, ids[-1])
+            if mark and last is mark:
+                raise StaleSheetMark(shard.title)  # отмеченной строки больше нет: лист стал короче
+            if last:
+                new_marks.append((shard.title, *last))
+        return self.journal.finish_import(full=marks is None, marks=new_marks)
+
+    def flush_once(self):
+        """
+        Выгружает одну пачку невыгруженных записей (по append_rows на шард); возвращает их число
+        """
+        with self.lock:
+            entries = self.journal.unsynced(self.batch)
+            for shard, group in self._by_shard(entries, lambda e: e["user_id"]):
+                if self.failures:
+                    # прошлая попытка могла дойти до таблицы — не дублируем уже записанное
+                    present = shard.entry_ids()
+                    self.journal.mark_synced([e["entry_id"] for e in group if e["entry_id"] in present])
+                    group = [e for e in group if e["entry_id"] not in present]
+                    if not group:
+                        continue
+                with observe("sheet_append"):
+                    shard.append([self.journal.to_sheet_row(e) for e in group])
+                self.journal.mark_synced([e["entry_id"] for e in group])
+                # досчитанные до выгрузки записи ушли с калориями — переписывать их не нужно
+                self.journal.mark_clean([e["entry_id"] for e in group if e["dirty"] and e["calories"] is not None])
+            return len(entries)
+
+    def push_updates(self):
+        """
+        Переписывает в таблице значения записей, изменённых после выгрузки (досчитанные калории):
+        по одному batch_update на шард. Возвращает число записей
+        """
+        with self.lock:
+            entries = self.journal.dirty(self.batch)
+            for shard, group in self._by_shard(entries, lambda e: e["user_id"]):
+                with observe("sheet_update"):
+                    shard.update_entries(group)
+                self.journal.mark_clean([e["entry_id"] for e in group])
+            return len(entries)
+
+    def flush_all(self):
+        while self.flush_once() == self.batch:
+            pass
+        while self.push_updates() == self.batch:
+            pass
+        self.compact()
+
+    def compact(self):
+        """
+        Удаляет помеченные записи из их шардов (по одному batch_update на шард).
+        Возвращает число удалённых строк таблицы
+        """
+        with self.lock:
+            synced, local_ids = self.journal.tombstones()
+            self.journal.purge(local_ids)
+            deleted = 0
+            for shard, group in self._by_shard(synced, lambda t: t[1]):
+                ids = [entry_id for entry_id, _ in group]
+                mark = self.journal.sheet_mark(shard.title)
+                with observe("sheet_compact"):
+                    rows, new_mark = shard.delete_entries(ids, mark)
+                if new_mark != mark:
+                    self.journal.set_sheet_mark(shard.title, new_mark)
+                self.journal.purge(ids)
+                deleted += len(rows)
+            return deleted
+
+    async def run(self):
+        while True:
+            try:
+                flushed = await run_blocking("sheets", self.flush_once)
+                await run_blocking("sheets", self.push_updates)
+                await run_blocking("sheets", self.compact)
+                self.failures = 0
+                if flushed == self.batch:
+                    continue
+                await asyncio.sleep(self.interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                delay = min(self.max_backoff, self.interval * 2 ** self.failures) * random.uniform(0.5, 1.5)
+                logger.error(f"Ошибка выгрузки в Google Sheets (попытка {self.failures}): {e}")
+                await asyncio.sleep(delay)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await run_blocking("sheets", self.flush_all)
+
+# === Хранилище: через него пишут, читают отчёты и очищают день ===
+class SQLiteStorage:
+    """
+    Бэкенд «только SQLite»: журнал в DATA_DIR — единственное хранилище, без Google Sheets
+    """
+    name = "sqlite"
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def add(self, user_id, username, dish, grams=None, calories=None, protein=None, fat=None, carbs=None):
+        return self.journal.add(user_id, username, dish, grams, calories, protein, fat, carbs, synced=True)
+
+    def daily_totals(self, user_id, day_from, day_to):
+        return self.journal.daily_totals(user_id, day_from, day_to)
+
+    def version(self, user_id):
+        return self.journal.version(user_id)
+
+    def clear_day(self, user_id, day):
+        return self.journal.tombstone_day(user_id, day, purge=True)
+
+    def fill_nutrition(self, results):
+        return self.journal.fill_nutrition(results, mark_dirty=False)
+
+    def stats(self):
+        return {"backend": self.name}
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+class SheetsStorage(SQLiteStorage):
+    """
+    Бэкенд Google Sheets: журнал в SQLite + фоновая выгрузка в лист или шарды по crc32(user_id).
+    К таблице подключаемся в фоне с повторами: пока её нет, записи копятся в журнале
+    """
+    name = "sheets"
+
+    def __init__(self, journal, connect, interval=5.0, batch=200, max_backoff=300.0, chunk_rows=5000,
+                 full_reload=False):
+        super().__init__(journal)
+        self.connect = connect  # блокирующая функция -> список SheetShard
+        self.syncer = SheetSyncer(journal, [], interval, batch, max_backoff, chunk_rows, full_reload)
+        self.task = None
+
+    def add(self, user_id, username, dish, grams=None, calories=None, protein=None, fat=None, carbs=None):
+        return self.journal.add(user_id, username, dish, grams, calories, protein, fat, carbs)
+
+    def clear_day(self, user_id, day):
+        # Локально удаление мгновенное; из таблицы строки уйдут одним запросом при синхронизации
+        return self.journal.tombstone_day(user_id, day)
+
+    def fill_nutrition(self, results):
+        # Выгруженные строки перепишет SheetSyncer.push_updates
+        return self.journal.fill_nutrition(results)
+
+    def stats(self):
+        return {"backend": self.name, "shards": len(self.syncer.shards), "unsynced": self.journal.unsynced_count()}
+
+    async def open(self):
+        self.task = asyncio.get_running_loop().create_task(self._connect())
+
+    async def _connect(self):
+        failures = 0
+        while True:
+            try:
+                self.syncer.shards = await run_blocking("sheets", self.connect)
+                mark_startup("sheets_connected")
+                # Журнал загружаем из таблицы, дальше он — основной источник для отчётов
+                loaded = await run_blocking("sheets", self.syncer.reload)
+                mark_startup("journal_loaded")
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                delay = min(self.syncer.max_backoff, 2 ** failures) * random.uniform(0.5, 1.5)
+                logger.error(f"Не удалось подключиться к Google Sheets (попытка {failures}): {e}")
+                await asyncio.sleep(delay)
+        logger.info(f"Журнал загружен из Google Sheets: {loaded} записей, шардов: {len(self.syncer.shards)}")
+        self.syncer.start()
+
+    async def close(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.syncer.task:
+            await self.syncer.stop()
+
+def _connect_sheets():
+    """
+    Подключение к листам-шардам (блокирующее: выполняется в пуле sheets после старта бота)
+    """
+    import gspread  # импорт и авторизация — не на пути холодного старта
+    if GCP_CREDENTIALS_JSON and not os.path.exists(GCP_CREDENTIALS_FILE):
+        with open(GCP_CREDENTIALS_FILE, "w") as f:
+            f.write(GCP_CREDENTIALS_JSON)
+    client = gspread.service_account(filename=GCP_CREDENTIALS_FILE)
+    return open_sheet_shards(client, SHARD_SPREADSHEETS, SHEET_NAME, SHEET_SHARDS)
+
+def make_storage(backend=STORAGE_BACKEND):
+    if backend == "sqlite":
+        return SQLiteStorage(journal)
+    if backend != "sheets":
+        raise ValueError(f"Неизвестный STORAGE_BACKEND: {backend} (доступно: sheets | sqlite)")
+    return SheetsStorage(
+        journal, _connect_sheets, SYNC_INTERVAL, SYNC_BATCH, chunk_rows=SHEET_READ_CHUNK, full_reload=SHEET_FULL_RELOAD,
+    )
+
+storage = make_storage()
+
+@timed("log_entry")
+def log_to_sheets(user_id, username, dish, grams=None, calories=None, protein=None, fat=None, carbs=None):
+    """
+    Записывает приём пищи через хранилище; в таблицу строка уйдёт с ближайшей синхронизацией
+    """
+    return storage.add(user_id, username, dish, grams, calories, protein, fat, carbs)
+
+def log_food_items(user_id, username, rows):
+    """
+    Записывает каждый продукт отдельной строкой (без калорий, если они не найдены)
+    """
+    for item, food_info in rows:
+        if food_info:
+            log_to_sheets(user_id, username, item, *(food_info[field] for field in NUTRIENT_FIELDS))
+        else:
+            log_to_sheets(user_id, username, item)
+
+# === Досчёт записей без калорий ===
+class NutritionBackfill:
+    """
+    Фоновый досчёт записей, сохранённых без калорий (ChatGPT был недоступен): пачками по batch,
+    не больше concurrency запросов к ChatGPT одновременно, через таблицу продуктов и кэш.
+    Неудачные попытки считаются в журнале, поэтому после перезапуска работа продолжается,
+    а безнадёжные записи через max_attempts попыток больше не запрашиваются
+    """
+    USER = BACKFILL_USER  # фоновая очередь FairScheduler: слот ей достаётся, только если пользователи не ждут
+
+    def __init__(self, storage, interval=60.0, batch=20, concurrency=2, items_per_call=10, max_attempts=3):
+        self.storage = storage
+        self.interval = interval
+        self.batch = batch
+        self.concurrency = concurrency
+        self.items_per_call = items_per_call
+        self.max_attempts = max_attempts
+        self.filled = 0
+        self.failed = 0
+        self.task = None
+
+    async def run_once(self):
+        """
+        Досчитывает одну пачку; возвращает число взятых записей.
+        Если ChatGPT недоступен, попытки не засчитываются и LLMUnavailableError пробрасывается
+        """
+        entries = self.storage.journal.missing_nutrition(self.batch, self.max_attempts)
+        if not entries:
+            return 0
+        dishes = list(dict.fromkeys(e["dish"] for e in entries if e["dish"]))
+        groups = [dishes[i:i + self.items_per_call] for i in range(0, len(dishes), self.items_per_call)]
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def resolve(group):
+            async with limit:
+                rows, _ = await resolve_food_items(group, self.USER, strict=True)
+                return rows
+
+        resolved = {}
+        unavailable = None
+        for result in await asyncio.gather(*(resolve(group) for group in groups), return_exceptions=True):
+            if isinstance(result, LLMUnavailableError):
+                unavailable = result
+            elif isinstance(result, Exception):
+                logger.error(f"Досчёт калорий: ошибка пачки: {result}")
+            else:
+                resolved.update(result)
+        # записи из пачек, где ChatGPT был недоступен, не трогаем — они не виноваты
+        results = [(e["entry_id"], resolved.get(e["dish"])) for e in entries if not e["dish"] or e["dish"] in resolved]
+        filled = self.storage.fill_nutrition(results)
+        self.filled += filled
+        self.failed += sum(info is None for _, info in results)
+        if unavailable is not None:
+            raise unavailable
+        return len(entries)
+
+    async def run(self):
+        while True:
+            try:
+                taken = await self.run_once()
+                # полная пачка — следующая сразу, но не чаще раза в секунду
+                await asyncio.sleep(1.0 if taken == self.batch else self.interval)
+            except asyncio.CancelledError:
+                raise
+            except LLMUnavailableError as e:
+                logger.warning(f"Досчёт калорий отложен: {e}")
+                await asyncio.sleep(self.interval)
+            except Exception as e:
+                logger.error(f"Ошибка досчёта калорий: {e}")
+                await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            "pending": self.storage.journal.missing_nutrition_count(self.max_attempts),
+            "filled": self.filled,
+            "failed": self.failed,
+        }
+
+backfill = NutritionBackfill(
+    storage, BACKFILL_INTERVAL, BACKFILL_BATCH, BACKFILL_CONCURRENCY, max_attempts=BACKFILL_MAX_ATTEMPTS,
+)
+
+# === Подготовка фото ===
+def pick_photo_size(photo_sizes, target_side=PHOTO_TARGET_SIDE):
+    """
+    Выбирает самый маленький PhotoSize, длинная сторона которого не меньше target_side
+    (Telegram присылает размеры по возрастанию); если такого нет — самый большой
+    """
+    for photo in photo_sizes:
+        if max(photo.width, photo.height) >= target_side:
+            return photo
+    return photo_sizes[-1]
+
+def prepare_image(image_bytes, target_side=PHOTO_TARGET_SIDE, quality=PHOTO_JPEG_QUALITY):
+    """
+    Уменьшает фото до target_side по длинной стороне и пережимает в JPEG.
+    Возвращает исходные байты, если результат не меньше или Pillow не установлен
+    """
+    if Image is None:
+        return image_bytes
     try:
-        return float(str(value).replace(",", "."))
-    except (ValueError, TypeError):
-        return 0.0
-
-# === Лог в Google Sheets ===
-def log_to_sheets(user_id, username, dish, grams="", calories="", protein="", fat="", carbs=""):
-    now = datetime.now()
-    date_str = now.strftime("%Y-%m-%d")
-    time_str = now.strftime("%H:%M:%S")
-    worksheet.append_row([
-        date_str, time_str, user_id, username, dish,
-        grams, calories, protein, fat, carbs
-    ])
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img = img.convert("RGB")
+            img.thumbnail((target_side, target_side))
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        logger.error(f"Не удалось пережать фото: {e}")
+        return image_bytes
+    prepared = buf.getvalue()
+    return prepared if len(prepared) < len(image_bytes) else image_bytes
+
+def image_phash(image_bytes):
+    """
+    Перцептивный хэш (dHash, 64 бита) изображения; None, если Pillow не установлен
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            pixels = list(img.convert("L").resize((9, 8)).getdata())
+    except Exception as e:
+        logger.error(f"Не удалось посчитать хэш фото: {e}")
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+class PhotoCache:
+    """
+    Кэш результатов распознавания фото: по file_unique_id от Telegram (без скачивания)
+    и по перцептивному хэшу для пересохранённых и пересланных копий
+    """
+    def __init__(self, conn, max_entries=2000, max_distance=6):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        self.id_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS photo_cache (
+                    file_unique_id TEXT PRIMARY KEY,
+                    phash TEXT,
+                    items TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS photo_cache_lru ON photo_cache(last_used)")
+
+    def get(self, file_unique_id):
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT items FROM photo_cache WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE photo_cache SET last_used = ? WHERE file_unique_id = ?", (time.time(), file_unique_id)
+            )
+            self.id_hits += 1
+        return json.loads(row["items"])
+
+    def find_similar(self, phash):
+        """
+        Ищет фото с хэшем не дальше max_distance бит; вызывается после промаха по file_unique_id
+        """
+        best = None
+        if phash is not None:
+            with self.lock:
+                rows = self.conn.execute("SELECT phash, items FROM photo_cache WHERE phash IS NOT NULL").fetchall()
+            for row in rows:
+                distance = bin(int(row["phash"], 16) ^ phash).count("1")
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, row["items"])
+        if best is None:
+            self.misses += 1
+            return None
+        self.hash_hits += 1
+        return json.loads(best[1])
+
+    def put(self, file_unique_id, phash, items):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO photo_cache VALUES (?, ?, ?, ?)",
+                (file_unique_id, None if phash is None else f"{phash:016x}",
+                 json.dumps(items, ensure_ascii=False), time.time()),
+            )
+            self.conn.execute(
+                "DELETE FROM photo_cache WHERE file_unique_id IN ("
+                "SELECT file_unique_id FROM photo_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        return {"id_hits": self.id_hits, "hash_hits": self.hash_hits, "misses": self.misses}
+
+photo_cache = PhotoCache(_open_db(), PHOTO_CACHE_MAX, PHOTO_HASH_DISTANCE)
 
 # === ChatGPT — распознать еду на фото ===
-def detect_food_in_photo(image_bytes, max_items=6):
+@timed("detect_photo")
+async def detect_food_in_photo(image_bytes, max_items=6, detail=PHOTO_DETAIL, user_id=None, on_delta=None):
     """
-    Распознаёт продукты питания на фото используя ChatGPT Vision
+    Распознаёт продукты питания на фото используя ChatGPT Vision.
+    on_delta — потоковый режим (см. llm_chat)
     """
     # image_bytes должен быть bytes, не bytearray
     if isinstance(image_bytes, bytearray):
         image_bytes = bytes(image_bytes)
 
+    # одно и то же фото (пересланное в несколько чатов) распознаётся один раз
+    key = (hashlib.sha256(image_bytes).hexdigest(), max_items, detail)
+    return await photo_flight.do(key, lambda: _ask_food_in_photo(image_bytes, max_items, detail, user_id, on_delta))
+
+async def _ask_food_in_photo(image_bytes, max_items, detail, user_id, on_delta=None):
+    """
+    Запрос к ChatGPT Vision для detect_food_in_photo
+    """
     # Кодируем изображение в base64
-    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-    
+    image_base64 = base64.b64encode(image_bytes).decode('ascii')
+    content = None
     try:
-        prompt = """
-        Проанализируй это изображение и определи, какие продукты питания на нём изображены, а также их примерное количество или вес.
-        
-        Верни ответ в строго определённом JSON формате:
-        {
-            "food_items": [
-                {"name": "название продукта", "amount": "примерное количество или вес"},
-                {"name": "название продукта", "amount": "примерное количество или вес"}
-            ]
-        }
-        
-        Правила:
-        1. Верни только съедобные продукты питания
-        2. Используй русские названия продуктов
-        3. Максимум 6 продуктов
-        4. Если на фото нет еды, верни пустой массив
-        5. Игнорируй посуду, мебель, одежду и другие непищевые предметы
-        6. Для количества используй: "1 шт", "2 шт", "150 г", "200 мл", "1 стакан", "1 тарелка" и т.д.
-        7. Если количество определить сложно, используй "1 порция"
-        8. Верни ТОЛЬКО JSON, без дополнительного текста
-        """
-        
-        response = openai.ChatCompletion.create(
+        response = await llm_chat(
+            user_id=user_id,
+            on_delta=on_delta,
+            purpose="photo",
             model="gpt-4o",
             messages=[
+                {"role": "system", "content": PHOTO_PROMPT},
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": prompt},
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
+                                "url": f"data:image/jpeg;base64,{image_base64}",
+                                "detail": detail
                             }
                         }
                     ]
                 }
             ],
-            max_tokens=300,
+            response_format=JSON_RESPONSE,
+            max_tokens=200,
             temperature=0.1
         )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # Парсим JSON ответ
-        import json
-        try:
-            # Пытаемся найти JSON в ответе
-            start_idx = content.find('{')
-            end_idx = content.rfind('}') + 1
-            if start_idx != -1 and end_idx != 0:
-                json_str = content[start_idx:end_idx]
-                data = json.loads(json_str)
-                food_items = data.get("food_items", [])
-                
-                # Формируем список продуктов с количеством
-                formatted_items = []
-                seen_names = set()
-                
-                for item in food_items:
-                    if isinstance(item, dict):
-                        name = item.get("name", "").strip().lower()
-                        amount = item.get("amount", "1 порция").strip()
-                    else:
-                        # Fallback для старого формата
-                        name = str(item).strip().lower()
-                        amount = "1 порция"
-                    
-                    if name and name not in seen_names:
-                        seen_names.add(name)
-                        formatted_items.append(f"{name} {amount}")
-                
-                return formatted_items[:max_items]
-                
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка парсинга JSON от ChatGPT Vision: {e}, ответ: {content}")
-            return []
-            
+        logger.info(f"Vision: {len(image_bytes)} байт (base64 {len(image_base64)}), detail={detail}")
+        content = response.choices[0].message.content
+        return format_detected_items(parse_items(content), max_items)
+    except LLMUnavailableError:
+        raise
+    except ValueError as e:  # в т.ч. json.JSONDecodeError
+        logger.error(f"Некорректный ответ ChatGPT Vision: {e}, ответ: {content}")
+        return []
     except Exception as e:
         logger.error(f"ChatGPT Vision запрос упал: {e}")
         return []
-    
-    return []
+
+def format_detected_items(food_items, max_items=6):
+    """
+    Продукты из ответа Vision -> ["название количество", ...] без повторов
+    """
+    formatted_items = []
+    seen_names = set()
+
+    for item in food_items:
+        name = item.get("name") if isinstance(item, dict) else None
+        amount = item.get("amount") or "1 порция" if isinstance(item, dict) else None
+        if not isinstance(name, str) or not isinstance(amount, str):
+            continue
+        name, amount = name.strip().lower(), amount.strip()
+
+        if name and name not in seen_names:
+            seen_names.add(name)
+            formatted_items.append(f"{name} {amount}")
+
+    return formatted_items[:max_items]
+
+_JSON_OBJECT_RE = re.compile(r"\{[^{}]*\}")
+
+def photo_progress(text):
+    """
+    Промежуточный текст по началу ответа Vision: продукты, объекты которых уже пришли целиком
+    """
+    start = text.find("[")
+    if start == -1:
+        return None
+    items = []
+    for m in _JSON_OBJECT_RE.finditer(text, start):
+        try:
+            items.append(json.loads(m.group(0)))
+        except json.JSONDecodeError:
+            continue
+    detected = format_detected_items(items)
+    return f"🔎 На фото вижу: {', '.join(detected)}…" if detected else None
 
 # === ОТЧЁТЫ ===
 async def handle_report(update, context):
@@ -266,10 +1884,14 @@ async def handle_report(update, context):
 
     if period == "today":
         period_start = today
+        chart_start = today - timedelta(days=29)
     elif period == "week":
         period_start = today - timedelta(days=today.weekday())
+        chart_start = period_start - timedelta(weeks=11)
     elif period == "month":
         period_start = today.replace(day=1)
+        year, month = divmod(today.year * 12 + today.month - 12, 12)
+        chart_start = date(year, month + 1, 1)
     else:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -277,35 +1899,13 @@ async def handle_report(update, context):
         )
         return
 
-    rows = worksheet.get_all_values()[1:]
-    records = []
-    for row in rows:
-        try:
-            row_user_id = row[2].strip()
-            if row_user_id != user_id:
-                continue
-            date_str = row[0].strip()
-            grams = row[5].strip()
-            cal = row[6].strip(); prot = row[7].strip(); fat = row[8].strip(); carb = row[9].strip()
-            if not cal:
-                continue
-            try:
-                date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
-            except ValueError:
-                try:
-                    date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
-                except ValueError:
-                    continue
-            records.append({
-                "date": date_obj,
-                "grams": safe_float(grams),
-                "cal": safe_float(cal),
-                "prot": safe_float(prot),
-                "fat": safe_float(fat),
-                "carb": safe_float(carb),
-            })
-        except Exception:
-            continue
+    records = [
+        {
+            "date": datetime.strptime(row["day"], "%Y-%m-%d").date(),
+            "grams": row["grams"], "cal": row["cal"], "prot": row["prot"], "fat": row["fat"], "carb": row["carb"],
+        }
+        for row in storage.daily_totals(user_id, chart_start, today)
+    ]
 
     if not records:
         await context.bot.send_message(
@@ -314,85 +1914,28 @@ async def handle_report(update, context):
         )
         return
 
-    df_all = pd.DataFrame(records)
-    df_all["date"] = pd.to_datetime(df_all["date"]).dt.date
-
-    df_sum = df_all[(df_all["date"] >= period_start) & (df_all["date"] <= today)]
-    if df_sum.empty:
+    period_records = [r for r in records if r["date"] >= period_start]
+    if not period_records:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="📭 У тебя нет данных за выбранный период."
         )
         return
 
-    # Данные для графика
-    if period == "today":
-        chart_start = today - timedelta(days=29)
-        df_chart = df_all[(df_all["date"] >= chart_start) & (df_all["date"] <= today)]
-        g = pd.DataFrame(df_chart).assign(date=pd.to_datetime(df_chart["date"])).groupby("date").sum(numeric_only=True).reset_index()
-        rng = pd.date_range(start=chart_start, end=today, freq="D")
-        full_df = pd.DataFrame({"date": rng})
-        grouped = full_df.merge(g, on="date", how="left").fillna(0)
-        grouped["label"] = grouped["date"].dt.strftime("%d.%m.%y")
-
-    elif period == "week":
-        this_monday = today - timedelta(days=today.weekday())
-        chart_start = this_monday - timedelta(weeks=11)
-        df_chart = df_all[(df_all["date"] >= chart_start) & (df_all["date"] <= today)]
-        df_tmp = pd.DataFrame(df_chart).assign(date=pd.to_datetime(df_chart["date"]))
-        iso = df_tmp["date"].dt.isocalendar()
-        df_tmp["year"] = iso.year.astype(int)
-        df_tmp["week"] = iso.week.astype(int)
-        g = df_tmp.groupby(["year", "week"]).sum(numeric_only=True).reset_index()
-        rng = pd.date_range(start=chart_start, end=this_monday, freq="W-MON")
-        iso_rng = rng.isocalendar()
-        full_df = pd.DataFrame({
-            "year": iso_rng.year.astype(int),
-            "week": iso_rng.week.astype(int),
-        }).drop_duplicates()
-        grouped = full_df.merge(g, on=["year", "week"], how="left").fillna(0)
-        grouped["label"] = grouped["week"].astype(int).astype(str)
-
-    else:  # month
-        first_day_cur = today.replace(day=1)
-        months_rng = pd.date_range(end=first_day_cur, periods=12, freq="MS")
-        chart_start = months_rng.min().date()
-        df_chart = df_all[(df_all["date"] >= chart_start) & (df_all["date"] <= today)]
-        df_tmp = pd.DataFrame(df_chart).assign(date=pd.to_datetime(df_chart["date"]))
-        df_tmp["year"] = df_tmp["date"].dt.year
-        df_tmp["month"] = df_tmp["date"].dt.month
-        g = df_tmp.groupby(["year", "month"]).sum(numeric_only=True).reset_index()
-        full_df = pd.DataFrame({
-            "year": months_rng.year,
-            "month": months_rng.month,
-        })
-        grouped = full_df.merge(g, on=["year", "month"], how="left").fillna(0)
-        grouped["label"] = grouped.apply(lambda r: f"{int(r['month']):02d}.{int(r['year'])%100:02d}", axis=1)
-
-    # График
-    plt.figure(figsize=(9, 5))
-    plt.plot(grouped["label"], grouped["grams"], marker="o", linewidth=2, label="Вес ⚖️")
-    plt.plot(grouped["label"], grouped["cal"], marker="o", linewidth=2, label="Калории 🔥")
-    plt.plot(grouped["label"], grouped["prot"], marker="o", linewidth=2, label="Белки 💪")
-    plt.plot(grouped["label"], grouped["fat"], marker="o", linewidth=2, label="Жиры 🥑")
-    plt.plot(grouped["label"], grouped["carb"], marker="o", linewidth=2, label="Углеводы 🍞")
-    plt.xlabel("Период", fontsize=12)
-    plt.ylabel("Количество", fontsize=12)
-    plt.title(f"Отчёт за {period}", fontsize=14)
-    plt.xticks(rotation=45)
-    plt.legend()
-    plt.grid(True, linestyle="--", alpha=0.7)
-    plt.tight_layout()
-    chart_path = "report_chart.png"
-    plt.savefig(chart_path)
-    plt.close()
+    # График: готовый PNG берём из кэша, пока данные пользователя не менялись
+    cache_key = (user_id, period, today, storage.version(user_id))
+    chart = report_charts.get(cache_key)
+    if chart is None:
+        with observe("render_chart"):
+            chart = await _render_chart(records, period, today)
+        report_charts.put(cache_key, chart)
 
     # Итоги
-    total_grams = df_sum["grams"].sum()
-    total_cal = df_sum["cal"].sum()
-    total_prot = df_sum["prot"].sum()
-    total_fat = df_sum["fat"].sum()
-    total_carb = df_sum["carb"].sum()
+    total_grams = sum(r["grams"] for r in period_records)
+    total_cal = sum(r["cal"] for r in period_records)
+    total_prot = sum(r["prot"] for r in period_records)
+    total_fat = sum(r["fat"] for r in period_records)
+    total_carb = sum(r["carb"] for r in period_records)
 
     text_report = (
         f"📊 Отчёт за {period}:\n"
@@ -404,78 +1947,105 @@ async def handle_report(update, context):
     )
 
     await context.bot.send_message(chat_id=update.effective_chat.id, text=text_report)
-    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=open(chart_path, "rb"))
+    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=chart)
+
+async def _render_chart(records, period, today):
+    """
+    PNG графика в пуле "report": туда уходят компактные массивы (номера дней и колонки сумм),
+    обратно — байты PNG. Если процесс пула упал, дальше графики строятся в потоках
+    """
+    days = array("l", (r["date"].toordinal() for r in records))
+    columns = [array("d", (r[name] for r in records)) for name in ("grams", "cal", "prot", "fat", "carb")]
+    from reports import build_report_png  # pandas и matplotlib — при первом отчёте, а не при старте
+    try:
+        return await run_blocking("report", build_report_png, days, columns, period, today)
+    except BrokenProcessPool as e:
+        logger.error(f"Пул процессов отчётов сломан, графики строятся в потоках: {e}")
+        _EXECUTORS["report"] = _EXECUTORS["render"]
+        return await run_blocking("report", build_report_png, days, columns, period, today)
+
+class ChartCache:
+    """
+    LRU-кэш готовых PNG графиков отчётов
+    """
+    def __init__(self, max_items=256):
+        self.max_items = max_items
+        self.items = OrderedDict()
+
+    def get(self, key):
+        png = self.items.get(key)
+        if png is not None:
+            self.items.move_to_end(key)
+        return png
+
+    def put(self, key, png):
+        self.items[key] = png
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+report_charts = ChartCache(REPORT_CACHE_SIZE)
 
 # === Обработчики ===
+async def _rate_limited(user_id, reply, cost=1.0):
+    """
+    Проверяет лимит запросов пользователя; при превышении отвечает через reply и возвращает True
+    """
+    wait = rate_limiter.take(str(user_id), cost)
+    if not wait:
+        return False
+    await reply(f"⏳ Слишком много запросов подряд. Попробуйте через {max(1, round(wait))} с.")
+    return True
+
 async def handle_text(update, context):
     user_id = update.message.from_user.id
     username = update.message.from_user.username or str(user_id)
     text = update.message.text or ""
+    if await _rate_limited(user_id, update.message.reply_text):
+        return
 
-    # Ожидание подтверждения по фото
-    if user_id in PENDING_CONFIRMATIONS:
-        pending_data = PENDING_CONFIRMATIONS.pop(user_id)  # Очищаем состояние
-        
+    # Ожидание подтверждения по фото: ответ на конкретное сообщение бота или последнее фото
+    reply_to = update.message.reply_to_message
+    detected_items = pending_confirmations.pop(user_id, reply_to.message_id if reply_to else None)
+    if detected_items is not None:
         # Если пользователь просто подтвердил (написал "да", "да", "ок" и т.д.)
         if text.lower().strip() in ['да', 'да', 'ок', 'ok', 'yes', 'верно', 'правильно']:
             # Используем уже распознанные продукты
-            detected_items = pending_data.get("detected", [])
             if detected_items:
-                # Объединяем все продукты в один запрос
-                combined_text = ", ".join(detected_items)
-                food_info = get_food_info(combined_text)
-                
-                if food_info:
-                    log_to_sheets(
-                        user_id, username, combined_text,
-                        food_info["grams"], food_info["calories"], food_info["protein"], food_info["fat"], food_info["carbs"]
-                    )
-                    await update.message.reply_text(
-                        f"🍽 {food_info['name'].title()}\n"
-                        f"⚖️ {food_info['grams']:.0f}г\n"
-                        f"🔥 {food_info['calories']:.0f}ккал\n"
-                        f"💪 Б{food_info['protein']:.1f}г\n"
-                        f"🥑 Ж{food_info['fat']:.1f}г\n"
-                        f"🍞 У{food_info['carbs']:.1f}г\n"
-                        f"✅ Записано в журнал!"
-                    )
-                else:
-                    log_to_sheets(user_id, username, combined_text)
-                    await update.message.reply_text("✅ Записано в журнал! (калории не найдены)")
+                # Каждый продукт считаем и записываем отдельно
+                rows, total = await resolve_food_items(detected_items, user_id)
+                log_food_items(user_id, username, rows)
+                await update.message.reply_text(format_food_items(rows, total))
             else:
                 await update.message.reply_text("❌ Не удалось обработать фото. Попробуйте написать продукты вручную.")
         else:
             # Пользователь написал конкретные продукты - обрабатываем как обычно
-            food_info = get_food_info(text)
-            
-            if food_info:
-                log_to_sheets(
-                    user_id, username, text,
-                    food_info["grams"], food_info["calories"], food_info["protein"], food_info["fat"], food_info["carbs"]
-                )
-                await update.message.reply_text(
-                    f"🍽 {food_info['name'].title()}\n"
-                    f"⚖️ {food_info['grams']:.0f}г\n"
-                    f"🔥 {food_info['calories']:.0f}ккал\n"
-                    f"💪 Б{food_info['protein']:.1f}г\n"
-                    f"🥑 Ж{food_info['fat']:.1f}г\n"
-                    f"🍞 У{food_info['carbs']:.1f}г\n"
-                    f"✅ Записано в журнал!"
-                )
-            else:
-                log_to_sheets(user_id, username, text)
-                await update.message.reply_text("✅ Записано в журнал! (калории не найдены)")
+            await _log_text_entry(update, user_id, username, text)
         return
 
     # Обычная текстовая запись
-    food_info = get_food_info(text)
+    await _log_text_entry(update, user_id, username, text)
+
+async def _log_text_entry(update, user_id, username, text):
+    """
+    Считает пищевую ценность текстовой записи, пишет её в журнал и отвечает пользователю
+    """
+    progress = ProgressiveReply(update.message.reply_text, "🧮 Считаю калории…", food_info_progress)
+    try:
+        food_info = await get_food_info(text, user_id, progress)
+    except LLMUnavailableError as e:
+        logger.error(f"ChatGPT недоступен: {e}")
+        log_to_sheets(user_id, username, text)
+        reason = "Очередь к ChatGPT переполнена" if isinstance(e, LLMBusyError) else "ChatGPT сейчас недоступен"
+        await progress.finish(f"✅ Записано в журнал! ⚠️ {reason}, калории не посчитаны.")
+        return
 
     if food_info:
         log_to_sheets(
             user_id, username, text,
             food_info["grams"], food_info["calories"], food_info["protein"], food_info["fat"], food_info["carbs"]
         )
-        await update.message.reply_text(
+        await progress.finish(
             f"🍽 {food_info['name'].title()}\n"
             f"⚖️ {food_info['grams']:.0f}г\n"
             f"🔥 {food_info['calories']:.0f}ккал\n"
@@ -486,39 +2056,29 @@ async def handle_text(update, context):
         )
     else:
         log_to_sheets(user_id, username, text)
-        await update.message.reply_text("✅ Записано в журнал! (калории не найдены)")
+        await progress.finish("✅ Записано в журнал! (калории не найдены)")
 
 async def handle_photo(update, context):
     user_id = update.message.from_user.id
-    photo = update.message.photo[-1]
-    file = await context.bot.get_file(photo.file_id)
-
-    # скачиваем как bytes
-    try:
-        image_bytes = await file.download_as_bytearray()
-        image_bytes = bytes(image_bytes)
-    except Exception as e:
-        logger.error(f"Не удалось скачать фото: {e}")
-        await update.message.reply_text("Не получилось скачать фото. Попробуй ещё раз.")
-        return
-
-    # распознаём продукты
-    try:
-        detected = detect_food_in_photo(image_bytes)
-    except Exception as e:
-        logger.error(f"Ошибка распознавания фото: {e}")
-        await update.message.reply_text("Не получилось распознать еду на фото. Напиши вручную, например: «банан 1шт, яблоко 150 г».")
+    if await _rate_limited(user_id, update.message.reply_text, RATE_LIMIT_PHOTO_COST):
         return
+    # Повторно присланное/пересланное фото узнаём по file_unique_id, даже не скачивая его
+    file_unique_id = update.message.photo[-1].file_unique_id
+    progress = ProgressiveReply(update.message.reply_text, "🔎 Распознаю фото…", photo_progress)
+    detected = photo_cache.get(file_unique_id)
+    if detected is None:
+        detected = await _recognize_photo(update, context, file_unique_id, progress)
+        if detected is None:
+            return
 
     if not detected:
-        await update.message.reply_text(
+        sent = await progress.finish(
             "На фото не распознал еду. Напиши, что на фото и сколько.\n\n"
             "Например: «овсянка 200г, кофе 250мл»")
-        PENDING_CONFIRMATIONS[user_id] = {"detected": []}
+        pending_confirmations.put(user_id, sent.message_id, [])
         return
 
     # Просим уточнить количество/вес с кнопками
-    PENDING_CONFIRMATIONS[user_id] = {"detected": detected}
     guess_list = ", ".join(detected)
     prompt = (
         f"На фото вижу: {guess_list}.\n\n"
@@ -530,7 +2090,60 @@ async def handle_photo(update, context):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(prompt, reply_markup=reply_markup)
+    sent = await progress.finish(prompt, reply_markup=reply_markup)
+    pending_confirmations.put(user_id, sent.message_id, detected)
+
+async def _recognize_photo(update, context, file_unique_id, progress):
+    """
+    Скачивает и распознаёт фото; ближайший дубликат по перцептивному хэшу берётся из кэша.
+    Пока идёт распознавание, пользователь видит заглушку progress и уже найденные продукты.
+    Возвращает None, если пользователю уже отправлено сообщение об ошибке
+    """
+    progress.start()
+    # берём не самый большой размер, а достаточный для распознавания
+    photo = pick_photo_size(update.message.photo)
+    file = await context.bot.get_file(photo.file_id)
+
+    # скачиваем как bytes
+    try:
+        with observe("photo_download"):
+            image_bytes = bytes(await file.download_as_bytearray())
+    except Exception as e:
+        logger.error(f"Не удалось скачать фото: {e}")
+        await progress.finish("Не получилось скачать фото. Попробуй ещё раз.")
+        return None
+
+    downloaded = len(image_bytes)
+    with observe("photo_prepare"):
+        image_bytes = await run_blocking("render", prepare_image, image_bytes)
+    largest = update.message.photo[-1]
+    logger.info(
+        f"Фото: {photo.width}x{photo.height} (самый большой {largest.width}x{largest.height}), "
+        f"скачано {downloaded} байт, к отправке {len(image_bytes)} байт"
+    )
+
+    phash = await run_blocking("render", image_phash, image_bytes)
+    detected = photo_cache.find_similar(phash)
+    if detected is not None:
+        photo_cache.put(file_unique_id, phash, detected)
+        return detected
+
+    # распознаём продукты
+    try:
+        detected = await detect_food_in_photo(
+            image_bytes, user_id=update.message.from_user.id, on_delta=progress.on_delta)
+    except LLMBusyError as e:
+        logger.warning(f"Фото отклонено: {e}")
+        await progress.finish("⏳ Сейчас слишком много фото в обработке. Отправьте это фото чуть позже.")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка распознавания фото: {e}")
+        await progress.finish("Не получилось распознать еду на фото. Напиши вручную, например: «банан 1шт, яблоко 150 г».")
+        return None
+
+    if detected:
+        photo_cache.put(file_unique_id, phash, detected)
+    return detected
 
 # === Приветствие ===
 async def start(update, context):
@@ -570,44 +2183,18 @@ async def clear_today_records(update, context):
     today = datetime.now().date()
     
     try:
-        # Получаем все записи
-        all_records = worksheet.get_all_values()
-        headers = all_records[0]  # Первая строка - заголовки
-        
-        # Находим строки для удаления (записи пользователя за сегодня)
-        rows_to_delete = []
-        for i, row in enumerate(all_records[1:], start=2):  # Начинаем со 2-й строки (индекс 1)
-            try:
-                record_user_id = row[2].strip()  # User ID в 3-м столбце
-                record_date_str = row[0].strip()  # Дата в 1-м столбце
-                
-                # Проверяем, что это запись пользователя за сегодня
-                if record_user_id == user_id:
-                    try:
-                        record_date = datetime.strptime(record_date_str, "%Y-%m-%d").date()
-                        if record_date == today:
-                            rows_to_delete.append(i)
-                    except ValueError:
-                        # Если формат даты другой, пропускаем
-                        continue
-            except IndexError:
-                # Если строка неполная, пропускаем
-                continue
+        deleted = storage.clear_day(user_id, today)
         
-        if not rows_to_delete:
+        if not deleted:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="📭 У вас нет записей за сегодня."
             )
             return
         
-        # Удаляем строки (с конца, чтобы индексы не сбились)
-        for row_index in reversed(rows_to_delete):
-            worksheet.delete_rows(row_index)
-        
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=f"🗑️ Удалено {len(rows_to_delete)} записей за сегодня!"
+            text=f"🗑️ Удалено {deleted} записей за сегодня!"
         )
         
     except Exception as e:
@@ -647,65 +2234,202 @@ async def button_handler(update, context):
     elif query.data == "clear_today":
         await clear_today_records(update, context)
     elif query.data == "accept_photo":
-        # Обрабатываем принятие фото как есть
-        user_id = query.from_user.id
-        username = query.from_user.username or str(user_id)
-        
-        if user_id in PENDING_CONFIRMATIONS:
-            pending_data = PENDING_CONFIRMATIONS.pop(user_id)
-            detected_items = pending_data.get("detected", [])
-            
-            if detected_items:
-                # Объединяем все продукты в один запрос
-                combined_text = ", ".join(detected_items)
-                food_info = get_food_info(combined_text)
-                
-                if food_info:
-                    log_to_sheets(
-                        user_id, username, combined_text,
-                        food_info["grams"], food_info["calories"], food_info["protein"], food_info["fat"], food_info["carbs"]
-                    )
-                    await query.edit_message_text(
-                        f"🍽 {food_info['name'].title()}\n"
-                        f"⚖️ {food_info['grams']:.0f}г\n"
-                        f"🔥 {food_info['calories']:.0f}ккал\n"
-                        f"💪 Б{food_info['protein']:.1f}г\n"
-                        f"🥑 Ж{food_info['fat']:.1f}г\n"
-                        f"🍞 У{food_info['carbs']:.1f}г\n"
-                        f"✅ Записано в журнал!"
-                    )
-                else:
-                    log_to_sheets(user_id, username, combined_text)
-                    await query.edit_message_text("✅ Записано в журнал! (калории не найдены)")
-            else:
-                await query.edit_message_text("❌ Не удалось обработать фото. Попробуйте написать продукты вручную.")
+        # Двойное нажатие обрабатывается один раз: дубль ждёт первое нажатие и ничего не делает сам
+        key = (query.from_user.id, query.message.message_id)
+        await accept_flight.do(key, lambda: _accept_photo(query))
+
+async def _accept_photo(query):
+    """
+    Принятие фото как есть: записывает распознанные продукты и заменяет сообщение с кнопкой итогом.
+    False — нажатие отклонено лимитом, его можно повторить
+    """
+    user_id = query.from_user.id
+    username = query.from_user.username or str(user_id)
+
+    if await _rate_limited(user_id, query.message.reply_text):
+        return False
+    detected_items = pending_confirmations.pop(user_id, query.message.message_id)
+    if detected_items is not None:
+        if detected_items:
+            # Каждый продукт считаем и записываем отдельно
+            rows, total = await resolve_food_items(detected_items, user_id)
+            log_food_items(user_id, username, rows)
+            await query.edit_message_text(format_food_items(rows, total))
         else:
-            await query.edit_message_text("❌ Данные о фото не найдены. Попробуйте отправить фото снова.")
-            
+            await query.edit_message_text("❌ Не удалось обработать фото. Попробуйте написать продукты вручную.")
+    else:
+        await query.edit_message_text("❌ Данные о фото не найдены. Попробуйте отправить фото снова.")
+    return True
 
 
+# === HTTP-сервер: health-check и webhook Telegram на одном $PORT ===
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+async def handle_health(request):
+    cache = nutrition_cache.stats()
+    return web.Response(text=(
+        "✅ Bot is alive!\n"
+        f"nutrition_cache: hits={cache['hits']} (rescaled={cache['rescaled']}) "
+        f"misses={cache['misses']} hit_rate={cache['hit_rate']}\n"
+        f"food_db: {food_db.stats() if food_db else 'off'}\n"
+        f"storage: {storage.stats()}\n"
+        f"startup: {STARTUP_TIMINGS}\n"
+        f"photo_cache: {photo_cache.stats()}\n"
+        f"pending_confirmations: {pending_confirmations.stats()}\n"
+        f"backfill: {backfill.stats()}\n"
+        f"rate_limit: {rate_limiter.stats()}\n"
+        f"llm_queue: {llm_scheduler.stats()}\n"
+        f"single_flight: { {flight.name: flight.stats() for flight in FLIGHTS} }\n"
+        f"llm_usage_today: {llm_usage.by_purpose()} top_users={llm_usage.top_users()}"
+    ))
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def handle_traces(request):
+    return web.json_response(list(tracer.recent), dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+# Состояние кэшей, очередей и хранилища считывается при каждом запросе /metrics
+metrics.callback("foodbot_nutrition_cache_total", "Обращения к кэшу пищевой ценности",
+                 lambda: {(k,): nutrition_cache.stats()[k] for k in ("hits", "rescaled", "misses")},
+                 kind="counter", labels=("result",))
+metrics.callback("foodbot_food_db_total", "Запросы к локальной таблице продуктов",
+                 lambda: {(k,): food_db.stats()[k] for k in ("hits", "misses")} if food_db else {},
+                 kind="counter", labels=("result",))
+metrics.callback("foodbot_photo_cache_total", "Обращения к кэшу распознавания фото",
+                 lambda: {(k,): v for k, v in photo_cache.stats().items()}, kind="counter", labels=("result",))
+metrics.callback("foodbot_pending_confirmations", "Фото, ожидающие подтверждения",
+                 lambda: pending_confirmations.stats()["pending"])
+metrics.callback("foodbot_journal_unsynced", "Записи журнала, ещё не выгруженные в таблицу",
+                 lambda: storage.stats().get("unsynced", 0))
+metrics.callback("foodbot_backfill_total", "Досчёт записей без калорий",
+                 lambda: {("filled",): backfill.filled, ("failed",): backfill.failed}, kind="counter", labels=("result",))
+metrics.callback("foodbot_backfill_pending", "Записи без калорий, ожидающие досчёта",
+                 lambda: backfill.stats()["pending"])
+metrics.callback("foodbot_rate_limited_total", "Запросы, отклонённые лимитом пользователя",
+                 lambda: rate_limiter.stats()["limited"], kind="counter")
+metrics.callback("foodbot_llm_queue_depth", "Запросы в очереди модели",
+                 lambda: {(m,): s["queued"] for m, s in llm_scheduler.stats().items()}, labels=("model",))
+metrics.callback("foodbot_llm_running", "Запросы к модели в работе",
+                 lambda: {(m,): s["running"] for m, s in llm_scheduler.stats().items()}, labels=("model",))
+metrics.callback("foodbot_llm_rejected_total", "Запросы, отклонённые из-за переполненной очереди",
+                 lambda: {(m,): s["rejected"] for m, s in llm_scheduler.stats().items()},
+                 kind="counter", labels=("model",))
+metrics.callback("foodbot_single_flight_total", "Вызовы через single-flight: started — новый запрос, joined — дубль",
+                 lambda: {(f.name, k): f.stats()[k] for f in FLIGHTS for k in ("started", "joined")},
+                 kind="counter", labels=("flight", "result"))
+metrics.callback("foodbot_llm_breaker_open", "Circuit breaker OpenAI разомкнут",
+                 lambda: int(llm_breaker.state != "closed"))
+metrics.callback("foodbot_startup_seconds", "Фазы запуска, секунды от старта процесса",
+                 lambda: {(phase,): seconds for phase, seconds in STARTUP_TIMINGS.items()}, labels=("phase",))
+
+async def handle_webhook(request):
+    """
+    Принимает апдейт от Telegram, проверяет секрет и ставит апдейт в очередь приложения
+    """
+    if not WEBHOOK_SECRET or not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+    ):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    app = request.app["bot_app"]
+    await app.update_queue.put(Update.de_json(data, app.bot))
+    return web.Response(text="ok")
+
+def build_web_app(app):
+    web_app = web.Application()
+    web_app["bot_app"] = app
+    web_app.router.add_get("/", handle_health)
+    web_app.router.add_get("/health", handle_health)
+    web_app.router.add_get("/metrics", handle_metrics)
+    web_app.router.add_get("/traces", handle_traces)
+    if BOT_MODE == "webhook":
+        web_app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return web_app
+
 # === Запуск ===
-if __name__ == "__main__":
-    # 1. Запускаем keepalive сервер для Render
-    _start_keepalive_server()
+async def _on_startup(app):
+    await storage.open()
+    backfill.start()
 
-    # 2. Запускаем Telegram-бота
-    builder = ApplicationBuilder().token(TOKEN)
+async def _on_shutdown(app):
+    await backfill.stop()
+    await storage.close()
+    if _EXECUTORS["report"] is not _EXECUTORS["render"]:
+        _EXECUTORS["report"].shutdown(wait=False, cancel_futures=True)
+
+def build_application():
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
     if PROXY_URL:
         builder = builder.request(HTTPXRequest(proxy_url=PROXY_URL))
     app = builder.build()
 
     # Команды
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("menu", menu))
-    app.add_handler(CommandHandler("report", handle_report))
+    app.add_handler(CommandHandler("start", instrumented(start)))
+    app.add_handler(CommandHandler("help", instrumented(help_cmd)))
+    app.add_handler(CommandHandler("menu", instrumented(menu)))
+    app.add_handler(CommandHandler("report", instrumented(handle_report)))
 
     # inline-кнопки
-    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_handler(CallbackQueryHandler(instrumented(button_handler)))
 
     # Сообщения
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(MessageHandler(filters.PHOTO, instrumented(handle_photo)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(handle_text)))
+    return app
+
+async def main():
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        # без секрета любой, кто знает адрес, может слать боту поддельные апдейты
+        raise SystemExit("Режим webhook требует WEBHOOK_SECRET")
+    app = build_application()
+    mark_startup("app_built")
+
+    # 1. HTTP-сервер поднимаем первым, чтобы Render видел живой сервис во время старта
+    runner = web.AppRunner(build_web_app(app), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    logger.info(f"HTTP server listening on port {PORT}, mode={BOT_MODE}")
+    mark_startup("http_listening")
 
-    app.run_polling(allowed_updates=["message", "callback_query"])
\ No newline at end of file
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # 2. Запускаем Telegram-бота
+    await app.initialize()
+    try:
+        await _on_startup(app)
+        if BOT_MODE == "webhook":
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            await app.bot.delete_webhook()
+            await app.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        await app.start()
+        mark_startup("accepting_updates")
+        await stop.wait()
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await runner.cleanup()
+        await _on_shutdown(app)
+        await app.shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,169 @@
+"""
+Локальный fake-сервер OpenAI Chat Completions для тестов и нагрузочных прогонов без сети.
+
+Запуск отдельно:
+    python fake_openai_server.py --port 8081 --latency 0.5 --error-rate 0.1
+    OPENAI_API_BASE=http://127.0.0.1:8081/v1 python bot.py
+
+или внутри бота: LLM_FAKE=1 python bot.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_GRAMS_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(?:г|гр|мл|g)\b", re.IGNORECASE)
+
+
+def _nutrition(text):
+    """
+    Детерминированные «пищевые ценности» для продукта: одинаковый текст — одинаковый ответ
+    """
+    seed = int(hashlib.md5(text.strip().lower().encode("utf-8")).hexdigest()[:8], 16)
+    m = _GRAMS_RE.search(text)
+    grams = float(m.group(1).replace(",", ".")) if m else 100.0
+    k = grams / 100
+    return {
+        "name": _GRAMS_RE.sub("", text).strip(" ,.") or text,
+        "grams": grams,
+        "calories": round((40 + seed % 400) * k, 1),
+        "protein": round((seed % 25) * k, 1),
+        "fat": round((seed // 25 % 30) * k, 1),
+        "carbs": round((seed // 750 % 60) * k, 1),
+    }
+
+
+def _answer(messages):
+    """
+    Ответ модели по последнему сообщению в формате бота ({"items": [...]}):
+    для фото — продукты с количеством, для текста — КБЖУ на каждую строку
+    """
+    content = messages[-1]["content"]
+    if isinstance(content, list):
+        return {"items": [
+            {"name": "гречка", "amount": "150 г"},
+            {"name": "куриная грудка", "amount": "120 г"},
+            {"name": "огурец", "amount": "1 шт"},
+        ]}
+    items = []
+    for line in filter(None, (line.strip() for line in content.splitlines())):
+        info = _nutrition(line)
+        items.append({"name": info["name"], "grams": info["grams"], "kcal": info["calories"],
+                      "p": info["protein"], "f": info["fat"], "c": info["carbs"]})
+    return {"items": items}
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0
+    seen_prefixes = set()  # системные промпты, уже «закэшированные» (как prompt caching у OpenAI)
+    cache_min_tokens = 1024  # у OpenAI кэш промптов работает только для запросов от 1024 токенов
+
+    def do_GET(self):
+        self._send(200, {"status": "ok"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        latency = random.uniform(0.5, 1.5) * self.latency if self.latency else 0.0
+        stream = bool(body.get("stream"))
+        # в потоковом режиме до первого куска проходит треть задержки, остальное — между кусками
+        time.sleep(latency / 3 if stream else latency)
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        if random.random() < self.error_rate:
+            status = random.choice((429, 500, 503))
+            self._send(status, {"error": {"message": f"injected {status}", "type": "server_error"}})
+            return
+        text = json.dumps(_answer(body.get("messages") or [{"content": ""}]), ensure_ascii=False)
+        messages = body.get("messages") or []
+        prompt_tokens = len(json.dumps(messages, ensure_ascii=False)) // 4
+        completion_tokens = len(text) // 4
+        system = messages[0]["content"] if messages and messages[0].get("role") == "system" else ""
+        cached_tokens = 0
+        if system in self.seen_prefixes and prompt_tokens >= self.cache_min_tokens:
+            cached_tokens = len(system) // 4 // 128 * 128  # кэшируется префикс блоками по 128 токенов
+        self.seen_prefixes.add(system)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        if stream:
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self._stream(body.get("model", "fake"), text, usage if include_usage else None, latency * 2 / 3)
+            return
+        self._send(200, {
+            "id": f"chatcmpl-fake-{random.getrandbits(32):08x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def _stream(self, model, text, usage, spread):
+        """
+        Ответ server-sent events, как при stream=True: текст кусками по 8 символов,
+        затем (если просили stream_options.include_usage) кусок с usage и [DONE]
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        base = {"id": f"chatcmpl-fake-{random.getrandbits(32):08x}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model}
+        pieces = [text[i:i + 8] for i in range(0, len(text), 8)]
+        chunks = [{**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}]
+        chunks += [{**base, "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]} for piece in pieces]
+        chunks.append({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if usage is not None:
+            chunks.append({**base, "choices": [], "usage": usage})
+        for chunk in chunks:
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if spread:
+                time.sleep(spread / len(chunks))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return  # отключаем лишние логи
+
+
+def make_server(port=0, latency=0.0, error_rate=0.0):
+    handler = type("Handler", (FakeOpenAIHandler,), {"latency": latency, "error_rate": error_rate})
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def start_in_thread(port=0, latency=0.0, error_rate=0.0):
+    """
+    Запускает сервер в фоновом потоке; возвращает api_base для openai
+    """
+    server = make_server(port, latency, error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="средняя задержка ответа, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429/5xx")
+    args = parser.parse_args()
+    server = make_server(args.port, args.latency, args.error_rate)
+    print(f"Fake OpenAI listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,197 @@
+"""
+Локальная таблица пищевой ценности (на 100 г) с нечётким поиском по триграммам.
+Частые продукты считаются без ChatGPT: одинаково при каждом запросе и за микросекунды.
+В ChatGPT уходят только запросы, для которых уверенного совпадения нет.
+"""
+import csv
+import re
+import threading
+from collections import namedtuple
+
+Food = namedtuple("Food", "name cal prot fat carb piece_g ml_g")
+
+# единица -> (во что переводится, множитель)
+_UNITS = {
+    "г": ("g", 1.0), "гр": ("g", 1.0), "грамм": ("g", 1.0), "грамма": ("g", 1.0), "граммов": ("g", 1.0),
+    "g": ("g", 1.0), "кг": ("g", 1000.0),
+    "мл": ("ml", 1.0), "ml": ("ml", 1.0), "л": ("ml", 1000.0),
+    "шт": ("pc", 1.0), "штука": ("pc", 1.0), "штуки": ("pc", 1.0), "штук": ("pc", 1.0),
+    "стакан": ("ml", 250.0), "стакана": ("ml", 250.0), "стаканов": ("ml", 250.0),
+}
+_NO_NUMBER_UNITS = ("стакан",)  # «стакан кефира» = 1 стакан
+_UNIT_PATTERN = "|".join(sorted(map(re.escape, _UNITS), key=len, reverse=True))
+_QUANTITY_RE = re.compile(rf"(?<![\w.,])(\d+(?:[.,]\d+)?)?\s*({_UNIT_PATTERN})(?!\w)\.?")
+_BARE_NUMBER_RE = re.compile(r"(?<![\w.,])(\d+(?:\.\d+)?)(?![\w.,%]|\s*%)")
+DEFAULT_GRAMS = 100.0  # как в промпте ChatGPT: без количества — стандартная порция
+MAX_BARE_PIECES = 10  # голое число больше этого — скорее вес без «г», чем штуки
+
+
+def normalize_name(text):
+    """
+    Регистр, ё/е, десятичная запятая, пунктуация и лишние пробелы
+    """
+    text = (text or "").lower().replace("ё", "е")
+    text = re.sub(r"(\d),(\d)", r"\1.\2", text)
+    text = re.sub(r"[^\w%.\- ]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip(" .-")
+
+
+def parse_quantity(text):
+    """
+    Отделяет количество от названия: "Гречка 150 г" -> ("гречка", 150.0, "g"),
+    "2 шт яйца" -> ("яйца", 2.0, "pc"), "стакан кефира" -> ("кефира", 250.0, "ml"),
+    "2 банана" -> ("банана", 2.0, None) — голое число, единицу выбирает to_grams.
+    Без количества -> (название, None, None); несколько количеств -> None
+    """
+    text = normalize_name(text)
+    matches = [
+        m for m in _QUANTITY_RE.finditer(text)
+        if m.group(1) is not None or m.group(2) in _NO_NUMBER_UNITS
+    ]
+    if len(matches) > 1:
+        return None
+    if matches:
+        m = matches[0]
+        kind, factor = _UNITS[m.group(2)]
+        amount = float(m.group(1)) if m.group(1) else 1.0
+        name = text[:m.start()] + " " + text[m.end():]
+        return normalize_name(name), amount * factor, kind
+    bare = list(_BARE_NUMBER_RE.finditer(text))
+    if len(bare) > 1:
+        return None
+    if bare:
+        m = bare[0]
+        return normalize_name(text[:m.start()] + " " + text[m.end():]), float(m.group(1)), None
+    return text, None, None
+
+
+def to_grams(food, amount, unit):
+    """
+    Количество в граммах для продукта или None, если единицу для него не перевести
+    (штуки без веса штуки, миллилитры не для напитка, голое число не похоже на штуки)
+    """
+    if amount is None:
+        return DEFAULT_GRAMS
+    if unit == "g":
+        return amount
+    if unit == "ml":
+        return amount * food.ml_g if food.ml_g else None
+    # голое число — штуки, только если это правдоподобное число штук: "банан 150" — это
+    # скорее граммы без «г», такой запрос уходит в ChatGPT
+    if unit is None and amount > MAX_BARE_PIECES:
+        return None
+    # "pc" или небольшое голое число: для штучных продуктов это штуки, иначе — непонятно
+    return amount * food.piece_g if food.piece_g else None
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FoodIndex:
+    """
+    Индекс названий и синонимов: точное совпадение по словарю, иначе — коэффициент Дайса
+    по общим триграммам (кандидаты берутся из инвертированного индекса триграмма -> названия)
+    """
+    def __init__(self, foods, aliases):
+        self.foods = foods
+        self.exact = {}
+        self.keys = []  # (food_index, число триграмм)
+        self.postings = {}
+        for food_index, names in enumerate(aliases):
+            for name in names:
+                key = normalize_name(name)
+                if not key or key in self.exact:
+                    continue
+                self.exact[key] = food_index
+                grams = trigrams(key)
+                for gram in grams:
+                    self.postings.setdefault(gram, []).append(len(self.keys))
+                self.keys.append((food_index, len(grams)))
+
+    def match(self, name):
+        """
+        Лучшее совпадение: (Food, оценка 0..1) или (None, 0.0)
+        """
+        key = normalize_name(name)
+        if key in self.exact:
+            return self.foods[self.exact[key]], 1.0
+        grams = trigrams(key)
+        shared = {}
+        for gram in grams:
+            for key_index in self.postings.get(gram, ()):
+                shared[key_index] = shared.get(key_index, 0) + 1
+        best, best_score = None, 0.0
+        for key_index, common in shared.items():
+            food_index, size = self.keys[key_index]
+            score = 2.0 * common / (len(grams) + size)
+            if score > best_score:
+                best, best_score = self.foods[food_index], score
+        return best, best_score
+
+
+class FoodDatabase:
+    """
+    Таблица продуктов из CSV (name, aliases через |, cal, prot, fat, carb на 100 г,
+    piece_g — вес одной штуки, ml_g — граммов в миллилитре для напитков)
+    """
+    def __init__(self, foods, aliases, min_score=0.8):
+        self.index = FoodIndex(foods, aliases)
+        self.min_score = min_score
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_csv(cls, path, min_score=0.8):
+        foods, aliases = [], []
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                foods.append(Food(
+                    row["name"], float(row["cal"]), float(row["prot"]), float(row["fat"]), float(row["carb"]),
+                    float(row["piece_g"]) if row.get("piece_g") else None,
+                    float(row["ml_g"]) if row.get("ml_g") else None,
+                ))
+                aliases.append([row["name"]] + [a for a in (row.get("aliases") or "").split("|") if a])
+        return cls(foods, aliases, min_score)
+
+    def __len__(self):
+        return len(self.index.foods)
+
+    def lookup(self, query):
+        """
+        Пищевая ценность в формате get_food_info или None, если продукт не найден уверенно
+        или его количество не перевести в граммы
+        """
+        parsed = parse_quantity(query)
+        info = None
+        if parsed is not None and parsed[0]:
+            name, amount, unit = parsed
+            food, score = self.index.match(name)
+            grams = to_grams(food, amount, unit) if food is not None and score >= self.min_score else None
+            if grams:
+                k = grams / 100.0
+                info = {
+                    "name": food.name,
+                    "grams": round(grams, 1),
+                    "calories": round(food.cal * k, 1),
+                    "protein": round(food.prot * k, 1),
+                    "fat": round(food.fat * k, 1),
+                    "carbs": round(food.carb * k, 1),
+                }
+        with self.lock:
+            if info is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return info
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "foods": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
@@ -0,0 +1,185 @@
+"""
+Метрики в текстовом формате Prometheus и трассировка обработки апдейтов.
+Без внешних зависимостей: счётчики и гистограммы живут в памяти процесса.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_INF = 'le="+Inf"'
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]  # по корзинам, сумма, всего
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        for key, (counts, total, count) in items:
+            for bound, in_bucket in zip(self.buckets, counts):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {in_bucket}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, _INF)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    Значение считывается при каждом запросе /metrics: fn() -> число или {(значения меток): число}
+    """
+    def __init__(self, name, help, fn, kind="gauge", labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self):
+        try:
+            values = self.fn()
+        except Exception as e:  # метрика не должна ронять весь /metrics
+            logger.error(f"Метрика {self.name} не считалась: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, k)} {_number(v or 0)}" for k, v in sorted(values.items())
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, fn, kind="gauge", labels=()):
+        return self._add(CallbackMetric(name, help, fn, kind, labels))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# === Трассировка ===
+_TRACE = contextvars.ContextVar("trace", default=None)
+
+
+class Tracer:
+    """
+    Разбивка времени обработки апдейта по шагам. Трассы не быстрее slow_ms пишутся в лог
+    и хранятся (последние keep) для /traces; slow_ms=0 — трассировка выключена
+    """
+    def __init__(self, slow_ms=0, keep=50):
+        self.slow_ms = slow_ms
+        self.recent = deque(maxlen=keep)
+
+    @contextmanager
+    def trace(self, name):
+        if not self.slow_ms or _TRACE.get() is not None:
+            yield
+            return
+        current = {
+            "name": name, "at": time.strftime("%Y-%m-%d %H:%M:%S"), "started": time.perf_counter(), "spans": [],
+        }
+        token = _TRACE.set(current)
+        try:
+            yield
+        finally:
+            _TRACE.reset(token)
+            total_ms = (time.perf_counter() - current["started"]) * 1000
+            if total_ms >= self.slow_ms:
+                done = {key: value for key, value in current.items() if key != "started"}
+                done["total_ms"] = round(total_ms, 1)
+                self.recent.append(done)
+                steps = ", ".join(f"{s['name']}={s['ms']}мс" for s in done["spans"])
+                logger.warning(f"Медленный апдейт {name}: {done['total_ms']} мс ({steps})")
+
+    @staticmethod
+    def add_span(name, started, seconds, error=False):
+        current = _TRACE.get()
+        if current is not None:
+            span = {"name": name, "offset_ms": round((started - current["started"]) * 1000, 1),
+                    "ms": round(seconds * 1000, 1)}
+            if error:
+                span["error"] = True
+            current["spans"].append(span)
@@ -0,0 +1,100 @@
+"""
+Перенос записей из общего листа (SPREADSHEET_NAME/SHEET_NAME) в другой бэкенд хранилища.
+
+Шарды Google Sheets (пользователь попадает в шард crc32(user_id) % N, как в боте):
+    python migrate_storage.py --shards 4
+    python migrate_storage.py --shards 4 --spreadsheets FoodLog,FoodLog2 --dry-run
+
+Локальная SQLite (бэкенд STORAGE_BACKEND=sqlite):
+    python migrate_storage.py --to sqlite --db /var/data/foodbot.sqlite3
+
+Исходный лист не меняется (кроме заполнения пустых entry_id в колонке K), поэтому перенос
+можно повторить: записи, которые уже есть в шарде, пропускаются. Бот на время переноса
+лучше остановить, после — задать STORAGE_BACKEND / SHEET_SHARDS / SHARD_SPREADSHEETS.
+"""
+import argparse
+import json
+import os
+
+import gspread
+from dotenv import load_dotenv
+
+from storage import (
+    EventJournal, NUTRIENT_COLUMNS, SheetShard, open_db, open_sheet_shards, shard_index, shard_titles,
+)
+
+ENTRY_FIELDS = ("entry_id", "day", "time", "user_id", "username", "dish") + NUTRIENT_COLUMNS
+
+
+def connect(credentials):
+    if credentials:
+        return gspread.service_account(filename=credentials)
+    return gspread.service_account_from_dict(json.loads(os.environ["GCP_CREDENTIALS_JSON"]))
+
+
+def split_by_shard(entries, shards):
+    grouped = [[] for _ in range(shards)]
+    for entry in entries:
+        grouped[shard_index(entry[3], shards)].append(dict(zip(ENTRY_FIELDS, entry)))
+    return grouped
+
+
+def to_shards(entries, shards, batch):
+    """
+    Дописывает записи в их шарды; возвращает {шард: число добавленных строк}
+    """
+    report = {}
+    for shard, group in zip(shards, split_by_shard(entries, len(shards))):
+        present = shard.entry_ids()
+        rows = [EventJournal.to_sheet_row(e) for e in group if e["entry_id"] not in present]
+        for start in range(0, len(rows), batch):
+            shard.append(rows[start:start + batch])
+        report[shard.title] = len(rows)
+    return report
+
+
+def to_sqlite(entries, path):
+    """
+    Загружает записи в журнал SQLite (заменяет записи, загруженные из таблицы ранее)
+    """
+    EventJournal(open_db(path)).reload_from_sheet(entries)
+    return {path: len(entries)}
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", choices=("sheets", "sqlite"), default="sheets")
+    parser.add_argument("--source-spreadsheet", default=os.environ.get("SPREADSHEET_NAME", "FoodLog"))
+    parser.add_argument("--source-sheet", default=os.environ.get("SHEET_NAME", "log"))
+    parser.add_argument("--shards", type=int, default=int(os.environ.get("SHEET_SHARDS", "2")))
+    parser.add_argument("--spreadsheets", help="таблицы для шардов через запятую (по умолчанию — исходная)")
+    parser.add_argument("--db", default=os.path.join(os.environ.get("DATA_DIR", "/tmp"), "foodbot.sqlite3"))
+    parser.add_argument("--batch", type=int, default=1000, help="строк за один append_rows")
+    parser.add_argument("--credentials", help="JSON сервисного аккаунта (по умолчанию — $GCP_CREDENTIALS_JSON)")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, ничего не записывать")
+    args = parser.parse_args()
+
+    client = connect(args.credentials)
+    source = SheetShard(client.open(args.source_spreadsheet).worksheet(args.source_sheet))
+    entries = source.read_entries(assign_ids=not args.dry_run)
+    print(f"{source.title}: {len(entries)} записей")
+
+    if args.to == "sqlite":
+        report = {args.db: len(entries)} if args.dry_run else to_sqlite(entries, args.db)
+    else:
+        if args.shards < 2:
+            parser.error("--shards должно быть не меньше 2: один шард — это исходный лист")
+        names = [n.strip() for n in (args.spreadsheets or args.source_spreadsheet).split(",")]
+        if args.dry_run:
+            titles = [f"{names[i % len(names)]}/{t}" for i, t in enumerate(shard_titles(args.source_sheet, args.shards))]
+            report = {t: len(group) for t, group in zip(titles, split_by_shard(entries, args.shards))}
+        else:
+            shards = open_sheet_shards(client, names, args.source_sheet, args.shards, create=True)
+            report = to_shards(entries, shards, args.batch)
+    for target, count in report.items():
+        print(f"  -> {target}: {count}{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    main()
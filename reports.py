@@ -0,0 +1,148 @@
+"""
+Агрегация данных для отчётов и построение графиков.
+Модуль не зависит от Telegram и Google Sheets: его используют бот и бенчмарки.
+"""
+import io
+from datetime import date
+
+import matplotlib
+matplotlib.use("Agg")  # серверный backend
+from matplotlib.figure import Figure
+import numpy as np
+import pandas as pd
+
+# Колонки листа: A..K
+SHEET_COLUMNS = ("date", "time", "user_id", "username", "dish", "grams", "cal", "prot", "fat", "carb", "entry_id")
+NUMERIC_COLUMNS = ("grams", "cal", "prot", "fat", "carb")
+
+
+def _stripped(values):
+    """
+    Обрезка пробелов списком: на object-колонках заметно быстрее, чем .str.strip()
+    """
+    return pd.Series([("" if v is None else str(v)).strip() for v in values], dtype=object)
+
+
+def parse_dates(values):
+    """
+    Векторный разбор дат: сначала %Y-%m-%d, для остальных — %d.%m.%Y; нераспознанные -> NaT
+    """
+    values = _stripped(values)
+    dates = pd.to_datetime(values, format="%Y-%m-%d", errors="coerce")
+    missing = dates.isna() & values.ne("")
+    if missing.any():
+        dates[missing] = pd.to_datetime(values[missing], format="%d.%m.%Y", errors="coerce")
+    return dates
+
+
+def parse_numbers(values):
+    """
+    Векторный разбор чисел с запятой или точкой; пустые и некорректные -> NaN
+    """
+    values = [("" if v is None else str(v)).replace(",", ".").strip() or "nan" for v in values]
+    try:
+        # быстрый путь: в листе только числа и пустые ячейки
+        return pd.Series(np.array(values, dtype="float64"))
+    except ValueError:
+        return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").astype("float64")
+
+
+def load_sheet_frame(rows):
+    """
+    Строки листа (без заголовка) -> типизированные колонки: date (datetime64), числа (float64), строки.
+    Короткие строки (незаполненные ячейки в конце) дополняются пустыми значениями
+    """
+    raw = pd.DataFrame(rows, dtype=object)
+    columns = {
+        name: raw[i].tolist() if i in raw.columns else [""] * len(raw)
+        for i, name in enumerate(SHEET_COLUMNS)
+    }
+    frame = pd.DataFrame({
+        "date": parse_dates(columns["date"]),
+        "time": _stripped(columns["time"]),
+        "user_id": _stripped(columns["user_id"]),
+        "username": pd.Series(["" if v is None else v for v in columns["username"]], dtype=object),
+        "dish": pd.Series(["" if v is None else v for v in columns["dish"]], dtype=object),
+        "entry_id": _stripped(columns["entry_id"]),
+    })
+    for column in NUMERIC_COLUMNS:
+        frame[column] = parse_numbers(columns[column])
+    return frame
+
+
+def bucket_series(frame, period, today):
+    """
+    Суммы для графика одной группировкой: 30 дней (today), 12 ISO-недель (week) или 12 месяцев (month).
+    frame: колонки date (datetime64) и NUMERIC_COLUMNS. Пустые периоды заполняются нулями
+    """
+    today = pd.Timestamp(today).normalize()
+    dates = frame["date"].dt.normalize()
+    if period == "today":
+        full = pd.date_range(end=today, periods=30, freq="D")
+        keys = dates
+    elif period == "week":
+        monday = today - pd.Timedelta(days=today.weekday())
+        full = pd.date_range(end=monday, periods=12, freq="7D")
+        keys = dates - pd.to_timedelta(dates.dt.weekday, unit="D")
+    else:  # month
+        full = pd.date_range(end=today.replace(day=1), periods=12, freq="MS")
+        keys = dates.dt.to_period("M").dt.start_time
+
+    mask = (dates >= full[0]) & (dates <= today)
+    grouped = (
+        frame.loc[mask, list(NUMERIC_COLUMNS)]
+        .groupby(keys[mask])
+        .sum()
+        .reindex(full, fill_value=0.0)
+    )
+    if period == "today":
+        labels = full.strftime("%d.%m.%y")
+    elif period == "week":
+        labels = full.isocalendar().week.astype(str).to_numpy()
+    else:
+        labels = full.strftime("%m.%y")
+    grouped.insert(0, "label", labels)
+    return grouped.reset_index(drop=True)
+
+
+def build_report_png(days, columns, period, today):
+    """
+    Группирует суммы по дням для графика и рисует его; возвращает PNG (bytes).
+    Принимает компактные массивы (удобно передавать в другой процесс):
+    days — номера дней date.toordinal(), columns — по массиву float на каждую из NUMERIC_COLUMNS
+    """
+    epoch = date(1970, 1, 1).toordinal()
+    frame = pd.DataFrame({"date": pd.to_datetime(np.asarray(days, dtype="int64") - epoch, unit="D")})
+    for name, values in zip(NUMERIC_COLUMNS, columns):
+        frame[name] = np.asarray(values, dtype="float64")
+    return render_report_chart(bucket_series(frame, period, today), period)
+
+
+def warm_up():
+    """
+    Прогрев процесса: импорт pandas/matplotlib, загрузка шрифтов и первый рендер — до первого отчёта
+    """
+    build_report_png([], [[]] * len(NUMERIC_COLUMNS), "today", date.today())
+
+
+def render_report_chart(grouped, period):
+    """
+    Рисует график через объектный API matplotlib (без глобального состояния pyplot) в память
+    """
+    fig = Figure(figsize=(9, 5))
+    ax = fig.subplots()
+    ax.plot(grouped["label"], grouped["grams"], marker="o", linewidth=2, label="Вес ⚖️")
+    ax.plot(grouped["label"], grouped["cal"], marker="o", linewidth=2, label="Калории 🔥")
+    ax.plot(grouped["label"], grouped["prot"], marker="o", linewidth=2, label="Белки 💪")
+    ax.plot(grouped["label"], grouped["fat"], marker="o", linewidth=2, label="Жиры 🥑")
+    ax.plot(grouped["label"], grouped["carb"], marker="o", linewidth=2, label="Углеводы 🍞")
+    ax.set_xlabel("Период", fontsize=12)
+    ax.set_ylabel("Количество", fontsize=12)
+    ax.set_title(f"Отчёт за {period}", fontsize=14)
+    ax.tick_params(axis="x", labelrotation=45)
+    ax.legend()
+    ax.grid(True, linestyle="--", alpha=0.7)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
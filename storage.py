@@ -0,0 +1,504 @@
+"""
+Хранилище записей о еде: локальный журнал (SQLite) и листы Google Sheets,
+между которыми пользователи распределяются по crc32(user_id).
+Модуль не зависит от Telegram: его используют бот и migrate_storage.py.
+"""
+import sqlite3
+import threading
+import uuid
+import zlib
+from datetime import datetime
+
+ENTRY_ID_COLUMN = 11  # колонка K: ключ идемпотентности записи
+NUTRIENT_COLUMNS = ("grams", "calories", "protein", "fat", "carbs")
+SHEET_HEADER = [
+    "Дата", "Время", "User ID", "Username", "Продукт",
+    "Вес (г)", "Калории", "Белки (г)", "Жиры (г)", "Углеводы (г)", "entry_id",
+]
+
+
+def open_db(path):
+    """
+    Открывает соединение с SQLite (WAL, можно использовать из пулов потоков)
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def shard_index(user_id, shards):
+    """
+    Номер шарда пользователя: стабилен между перезапусками (в отличие от hash())
+    """
+    return zlib.crc32(str(user_id).encode("utf-8")) % shards if shards > 1 else 0
+
+
+# === Журнал ===
+class EventJournal:
+    """
+    Локальный журнал записей о еде. Запись сохраняется сюда сразу,
+    в Google Sheets её пачками переносит SheetSyncer
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.epoch = 0  # меняется при полной перезагрузке из таблицы
+        self.versions = {}  # user_id -> номер изменения данных пользователя
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    entry_id TEXT NOT NULL UNIQUE,
+                    day TEXT NOT NULL,
+                    time TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    username TEXT,
+                    dish TEXT,
+                    grams REAL, calories REAL, protein REAL, fat REAL, carbs REAL,
+                    synced INTEGER NOT NULL DEFAULT 0,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    dirty INTEGER NOT NULL DEFAULT 0,
+                    backfill_attempts INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(entries)")}
+            # dirty: значения изменились после выгрузки; backfill_attempts: попытки досчитать калории
+            for column in ("deleted", "dirty", "backfill_attempts"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE entries ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_user_day ON entries(user_id, day)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_unsynced ON entries(synced) WHERE synced = 0")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_deleted ON entries(deleted) WHERE deleted = 1")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_dirty ON entries(dirty) WHERE dirty = 1")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_missing ON entries(backfill_attempts) "
+                "WHERE calories IS NULL AND deleted = 0"
+            )
+            # Индекс для отчётов: суммы по (пользователь, день), обновляются вместе с записями
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS daily_totals (
+                    user_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    entries INTEGER NOT NULL,
+                    grams REAL NOT NULL, cal REAL NOT NULL, prot REAL NOT NULL, fat REAL NOT NULL, carb REAL NOT NULL,
+                    PRIMARY KEY (user_id, day)
+                )
+            """)
+            # Загрузка листа по частям: окна копятся здесь, в entries попадают одной транзакцией
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS sheet_import (
+                    entry_id TEXT PRIMARY KEY,
+                    day TEXT, time TEXT, user_id TEXT, username TEXT, dish TEXT,
+                    grams REAL, calories REAL, protein REAL, fat REAL, carbs REAL
+                )
+            """)
+            # Высшая отметка по листу: последняя прочитанная строка и её entry_id (для проверки)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS sheet_marks (
+                    shard TEXT PRIMARY KEY,
+                    row INTEGER NOT NULL,
+                    entry_id TEXT NOT NULL
+                )
+            """)
+
+    def add(self, user_id, username, dish, grams=None, calories=None, protein=None, fat=None, carbs=None,
+            synced=False):
+        """
+        Сохраняет запись; synced=True — запись никуда не выгружается (бэкенд только SQLite)
+        """
+        now = datetime.now()
+        entry_id = uuid.uuid4().hex
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO entries (entry_id, day, time, user_id, username, dish, grams, calories, protein, fat, carbs, "
+                "synced) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry_id, now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"), str(user_id), username, dish,
+                 grams, calories, protein, fat, carbs, int(synced)),
+            )
+            self._update_totals([(str(user_id), now.strftime("%Y-%m-%d"), grams, calories, protein, fat, carbs)], 1)
+            self._bump(user_id)
+        return entry_id
+
+    def _bump(self, user_id):
+        user_id = str(user_id)
+        self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+    def version(self, user_id):
+        """
+        Версия данных пользователя: меняется при любой записи или удалении
+        """
+        return self.epoch, self.versions.get(str(user_id), 0)
+
+    def _update_totals(self, values, sign):
+        """
+        Добавляет (sign=1) или вычитает (sign=-1) записи из daily_totals.
+        values: (user_id, day, grams, calories, protein, fat, carbs); записи без калорий не учитываются
+        """
+        values = [
+            (user_id, day, sign, *(sign * (v or 0.0) for v in nums))
+            for user_id, day, *nums in values if nums[1] is not None
+        ]
+        if not values:
+            return
+        self.conn.executemany("""
+            INSERT INTO daily_totals VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                entries = entries + excluded.entries,
+                grams = grams + excluded.grams, cal = cal + excluded.cal, prot = prot + excluded.prot,
+                fat = fat + excluded.fat, carb = carb + excluded.carb
+        """, values)
+        self.conn.execute("DELETE FROM daily_totals WHERE entries <= 0")
+
+    def _rebuild_totals(self):
+        self.conn.execute("DELETE FROM daily_totals")
+        self.conn.execute("""
+            INSERT INTO daily_totals
+            SELECT user_id, day, COUNT(*), SUM(COALESCE(grams, 0)), SUM(calories),
+                   SUM(COALESCE(protein, 0)), SUM(COALESCE(fat, 0)), SUM(COALESCE(carbs, 0))
+            FROM entries WHERE calories IS NOT NULL
+            GROUP BY user_id, day
+        """)
+
+    def daily_totals(self, user_id, day_from, day_to):
+        """
+        Суммы по дням для отчёта: O(число дней), а не O(числа строк)
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM daily_totals WHERE user_id = ? AND day >= ? AND day <= ? ORDER BY day",
+                (str(user_id), day_from.isoformat(), day_to.isoformat()),
+            ).fetchall()
+
+    def unsynced(self, limit):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM entries WHERE synced = 0 AND deleted = 0 ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+
+    def unsynced_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries WHERE synced = 0 AND deleted = 0").fetchone()[0]
+
+    def mark_synced(self, entry_ids):
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE entries SET synced = 1 WHERE entry_id = ?", [(e,) for e in entry_ids])
+
+    def missing_nutrition(self, limit, max_attempts=3):
+        """
+        Записи без калорий (ChatGPT был недоступен), которые ещё стоит досчитать; сначала свежие
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT entry_id, user_id, day, dish FROM entries "
+                "WHERE calories IS NULL AND deleted = 0 AND backfill_attempts < ? ORDER BY id DESC LIMIT ?",
+                (max_attempts, limit),
+            ).fetchall()
+
+    def missing_nutrition_count(self, max_attempts=3):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM entries WHERE calories IS NULL AND deleted = 0 AND backfill_attempts < ?",
+                (max_attempts,),
+            ).fetchone()[0]
+
+    def fill_nutrition(self, results, mark_dirty=True):
+        """
+        Записывает досчитанные значения: results — [(entry_id, info или None)], info в формате
+        get_food_info. Для None увеличивается счётчик попыток. mark_dirty — строку в таблице
+        нужно переписать (SheetSyncer.push_updates). Возвращает число заполненных записей
+        """
+        filled = []
+        with self.lock, self.conn:
+            for entry_id, info in results:
+                if info is None:
+                    self.conn.execute(
+                        "UPDATE entries SET backfill_attempts = backfill_attempts + 1 WHERE entry_id = ?", (entry_id,)
+                    )
+                    continue
+                row = self.conn.execute(
+                    "SELECT user_id, day FROM entries WHERE entry_id = ? AND calories IS NULL AND deleted = 0",
+                    (entry_id,),
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE entries SET grams = ?, calories = ?, protein = ?, fat = ?, carbs = ?, dirty = ? "
+                        "WHERE entry_id = ?",
+                        (*(info[field] for field in NUTRIENT_COLUMNS), int(mark_dirty), entry_id),
+                    )
+                    filled.append((row["user_id"], row["day"], *(info[field] for field in NUTRIENT_COLUMNS)))
+            self._update_totals(filled, 1)
+            for user_id, *_ in filled:
+                self._bump(user_id)
+        return len(filled)
+
+    def dirty(self, limit):
+        """
+        Уже выгруженные записи, значения которых нужно переписать в таблице
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM entries WHERE dirty = 1 AND synced = 1 AND deleted = 0 ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+
+    def mark_clean(self, entry_ids):
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE entries SET dirty = 0 WHERE entry_id = ?", [(e,) for e in entry_ids])
+
+    def tombstone_day(self, user_id, day, purge=False):
+        """
+        Помечает записи пользователя за день удалёнными (одной транзакцией).
+        Из таблицы их уберёт SheetSyncer.compact; purge=True — удаляет сразу (таблицы нет).
+        Возвращает число записей
+        """
+        with self.lock, self.conn:
+            rows = self.conn.execute(
+                "SELECT user_id, day, grams, calories, protein, fat, carbs FROM entries "
+                "WHERE user_id = ? AND day = ? AND deleted = 0",
+                (str(user_id), day.isoformat()),
+            ).fetchall()
+            self.conn.execute(
+                "DELETE FROM entries WHERE user_id = ? AND day = ? AND deleted = 0" if purge else
+                "UPDATE entries SET deleted = 1 WHERE user_id = ? AND day = ? AND deleted = 0",
+                (str(user_id), day.isoformat()),
+            )
+            self._update_totals([tuple(row) for row in rows], -1)
+            self._bump(user_id)
+        return len(rows)
+
+    def tombstones(self):
+        """
+        Удалённые записи, ожидающие компакции: (уже выгруженные (entry_id, user_id), невыгруженные entry_id)
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT entry_id, user_id, synced FROM entries WHERE deleted = 1").fetchall()
+        return [(r["entry_id"], r["user_id"]) for r in rows if r["synced"]], [r["entry_id"] for r in rows if not r["synced"]]
+
+    def purge(self, entry_ids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM entries WHERE entry_id = ? AND deleted = 1", [(e,) for e in entry_ids]
+            )
+
+    def reload_from_sheet(self, sheet_entries):
+        """
+        Заменяет выгруженные записи содержимым таблицы (все записи сразу)
+        """
+        self.start_import()
+        self.stage_import(sheet_entries)
+        return self.finish_import()
+
+    def start_import(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM sheet_import")
+
+    def stage_import(self, sheet_entries):
+        """
+        Откладывает окно записей листа до finish_import: отчёты не видят наполовину загруженную таблицу
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sheet_import VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", sheet_entries
+            )
+
+    def finish_import(self, full=True, marks=()):
+        """
+        Переносит отложенные записи в журнал одной транзакцией. full=True заменяет все выгруженные
+        записи, иначе добавляет новые (дочитанный хвост листа). Невыгруженные записи сохраняются,
+        а те из них, что уже есть в таблице, помечаются выгруженными; удалённые остаются удалёнными
+        до компакции. marks: [(шард, строка, entry_id)] — новые высшие отметки листов.
+        Возвращает число загруженных строк
+        """
+        with self.lock, self.conn:
+            if full:
+                # изменённые локально (досчитанные) записи ещё не переписаны в таблице — их не трогаем
+                self.conn.execute("DELETE FROM entries WHERE synced = 1 AND deleted = 0 AND dirty = 0")
+                self.conn.execute("DELETE FROM sheet_marks")
+            self.conn.execute(
+                "UPDATE entries SET synced = 1 WHERE synced = 0 AND entry_id IN (SELECT entry_id FROM sheet_import)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO entries (entry_id, day, time, user_id, username, dish, "
+                "grams, calories, protein, fat, carbs, synced) "
+                "SELECT entry_id, day, time, user_id, username, dish, grams, calories, protein, fat, carbs, 1 "
+                "FROM sheet_import"
+            )
+            loaded = self.conn.execute("SELECT COUNT(*) FROM sheet_import").fetchone()[0]
+            self.conn.execute("DELETE FROM sheet_import")
+            self.conn.executemany("INSERT OR REPLACE INTO sheet_marks VALUES (?, ?, ?)", marks)
+            self._rebuild_totals()
+            self.epoch += 1
+        return loaded
+
+    def sheet_mark(self, shard):
+        """
+        (последняя прочитанная строка, её entry_id) для листа или None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT row, entry_id FROM sheet_marks WHERE shard = ?", (shard,)).fetchone()
+        return (row["row"], row["entry_id"]) if row else None
+
+    def set_sheet_mark(self, shard, mark):
+        with self.lock, self.conn:
+            if mark is None:
+                self.conn.execute("DELETE FROM sheet_marks WHERE shard = ?", (shard,))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO sheet_marks VALUES (?, ?, ?)", (shard, *mark))
+
+    @staticmethod
+    def to_sheet_row(entry):
+        return [entry["day"], entry["time"], entry["user_id"], entry["username"], entry["dish"]] + [
+            "" if entry[field] is None else entry[field] for field in NUTRIENT_COLUMNS
+        ] + [entry["entry_id"]]
+
+
+def _row_ranges(rows):
+    """
+    Группирует номера строк в смежные диапазоны: [2, 3, 4, 7] -> [(2, 4), (7, 7)]
+    """
+    ranges = []
+    for row in sorted(rows):
+        if ranges and row == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], row)
+        else:
+            ranges.append((row, row))
+    return ranges
+
+
+# === Листы Google Sheets ===
+class SheetShard:
+    """
+    Один лист с записями: чтение, дозапись пачкой и удаление строк по entry_id
+    """
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    @property
+    def title(self):
+        return f"{self.worksheet.spreadsheet.title}/{self.worksheet.title}"
+
+    def entry_ids(self):
+        return set(self.worksheet.col_values(ENTRY_ID_COLUMN)[1:])
+
+    def read_entries(self, assign_ids=True, chunk_rows=5000):
+        """
+        Все записи листа кортежами для EventJournal.reload_from_sheet
+        """
+        return [e for _, _, entries in self.iter_entries(2, chunk_rows, assign_ids) for e in entries]
+
+    def iter_rows(self, start_row=2, chunk_rows=5000):
+        """
+        Строки листа (A:K) окнами по chunk_rows, начиная со start_row: (номер первой строки, строки).
+        Весь лист в память не загружается; пустой хвост окна не означает конец, пока не кончилась сетка листа
+        """
+        row = start_row
+        while True:
+            end = row + chunk_rows - 1
+            rows = self.worksheet.get(f"A{row}:K{end}")
+            if rows:
+                yield row, [list(r) for r in rows]
+            if len(rows) < chunk_rows and end >= self.worksheet.row_count:
+                return
+            row = end + 1
+
+    def iter_entries(self, start_row=2, chunk_rows=5000, assign_ids=True):
+        """
+        Записи листа по окнам: (номер первой строки, entry_id каждой строки окна, записи для журнала).
+        Строкам без entry_id он присваивается (и записывается в колонку K окна, если assign_ids)
+        """
+        from reports import load_sheet_frame  # pandas нужен только при загрузке листа
+        ws = self.worksheet
+        for first_row, rows in self.iter_rows(start_row, chunk_rows):
+            frame = load_sheet_frame(rows)
+            missing = frame["entry_id"].isna() | frame["entry_id"].eq("")
+            if missing.any():
+                frame.loc[missing, "entry_id"] = [uuid.uuid4().hex for _ in range(int(missing.sum()))]
+                if assign_ids:
+                    if ws.col_count < ENTRY_ID_COLUMN:
+                        ws.add_cols(ENTRY_ID_COLUMN - ws.col_count)
+                    ids_column = [[entry_id] for entry_id in frame["entry_id"]]
+                    top = first_row
+                    if first_row == 2:  # первое окно — заодно заголовок колонки
+                        ids_column.insert(0, [SHEET_HEADER[-1]])
+                        top = 1
+                    ws.update(f"K{top}:K{first_row + len(frame) - 1}", ids_column)
+            ids = frame["entry_id"].tolist()
+            frame = frame[frame["date"].notna()]
+            numbers = frame[["grams", "cal", "prot", "fat", "carb"]].astype(object)
+            numbers = numbers.where(numbers.notna(), None)
+            yield first_row, ids, list(zip(
+                frame["entry_id"], frame["date"].dt.strftime("%Y-%m-%d"), frame["time"], frame["user_id"],
+                frame["username"], frame["dish"], *(numbers[column] for column in numbers.columns),
+            ))
+
+    def append(self, rows):
+        self.worksheet.append_rows(rows, value_input_option="RAW")
+
+    def update_entries(self, entries):
+        """
+        Переписывает вес и КБЖУ (F:J) строк с данными entry_id одним batch_update.
+        Строки, которых в листе уже нет, пропускаются. Возвращает число обновлённых строк
+        """
+        rows = {value: i for i, value in enumerate(self.worksheet.col_values(ENTRY_ID_COLUMN), start=1)}
+        data = [
+            {"range": f"F{rows[e['entry_id']]}:J{rows[e['entry_id']]}",
+             "values": [["" if e[field] is None else e[field] for field in NUTRIENT_COLUMNS]]}
+            for e in entries if e["entry_id"] in rows
+        ]
+        if data:
+            self.worksheet.batch_update(data, value_input_option="RAW")
+        return len(data)
+
+    def delete_entries(self, entry_ids, mark=None):
+        """
+        Удаляет строки с данными entry_id одним batch_update (смежные строки — одним диапазоном).
+        mark — высшая отметка листа (строка, entry_id). Возвращает (номера удалённых строк, отметку
+        после удаления: последняя уцелевшая строка не ниже прежней или None)
+        """
+        wanted = set(entry_ids)
+        ids_column = self.worksheet.col_values(ENTRY_ID_COLUMN)
+        rows = [i for i, v in enumerate(ids_column, start=1) if v in wanted]
+        requests = [
+            {"deleteDimension": {"range": {
+                "sheetId": self.worksheet.id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end,
+            }}}
+            for start, end in reversed(_row_ranges(rows))
+        ]
+        if requests:
+            self.worksheet.spreadsheet.batch_update({"requests": requests})
+        if mark is not None and rows:
+            removed = set(rows)
+            kept = [value for i, value in enumerate(ids_column, start=1) if i not in removed and i <= mark[0]]
+            mark = (len(kept), kept[-1]) if len(kept) > 1 else None
+        return rows, mark
+
+
+def shard_titles(sheet_name, shards):
+    """
+    Имена листов-шардов: один шард — сам лист sheet_name, иначе sheet_name_0..sheet_name_{N-1}
+    """
+    return [sheet_name] if shards <= 1 else [f"{sheet_name}_{i}" for i in range(shards)]
+
+
+def open_sheet_shards(client, spreadsheet_names, sheet_name, shards=1, create=False):
+    """
+    Открывает листы-шарды; шард i лежит в таблице spreadsheet_names[i % len(spreadsheet_names)].
+    create=True создаёт недостающие листы с заголовком
+    """
+    import gspread
+    books = {}
+    result = []
+    for i, title in enumerate(shard_titles(sheet_name, shards)):
+        name = spreadsheet_names[i % len(spreadsheet_names)]
+        if name not in books:
+            books[name] = client.open(name)
+        try:
+            worksheet = books[name].worksheet(title)
+        except gspread.WorksheetNotFound:
+            if not create:
+                raise
+            worksheet = books[name].add_worksheet(title, rows=1000, cols=len(SHEET_HEADER))
+            worksheet.append_row(SHEET_HEADER)
+        result.append(SheetShard(worksheet))
+    return result
@@ -0,0 +1,15 @@
+"""
+Окружение для импорта bot.py без сети: bot.py читает настройки при загрузке модуля.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+for name, value in (
+    ("TOKEN", "0:test"), ("OPENAI_API_KEY", "sk-test"), ("STORAGE_BACKEND", "sqlite"),
+    ("LOG_LEVEL", "CRITICAL"), ("REPORT_PROCESSES", "0"),
+):
+    os.environ.setdefault(name, value)
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="foodbot-test-"))
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = bot.CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    monkeypatch.setattr(bot, "llm_breaker", breaker)
+    monkeypatch.setattr(bot, "LLM_RETRIES", 0)
+    return breaker
+
+
+def _fail_with(monkeypatch, error):
+    def create(**kwargs):
+        raise error
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+
+
+def _call():
+    return asyncio.run(bot._llm_chat(model="gpt-3.5-turbo", messages=[]))
+
+
+def _open_and_cool_down(monkeypatch, breaker):
+    _fail_with(monkeypatch, openai.error.ServiceUnavailableError("503", http_status=503))
+    with pytest.raises(bot.LLMUnavailableError):
+        _call()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+
+
+def test_probe_with_non_retryable_error_closes_breaker(monkeypatch, breaker):
+    _open_and_cool_down(monkeypatch, breaker)
+    _fail_with(monkeypatch, openai.error.InvalidRequestError("bad request", None, http_status=400))
+    with pytest.raises(openai.error.InvalidRequestError):
+        _call()
+    assert breaker.state == "closed"
+    assert not breaker.probing
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", lambda **kwargs: {"choices": [], "usage": {}})
+    assert _call() == {"choices": [], "usage": {}}
+
+
+def test_cancelled_probe_lets_next_call_probe(monkeypatch, breaker):
+    _open_and_cool_down(monkeypatch, breaker)
+    monkeypatch.setattr(openai.ChatCompletion, "create", lambda **kwargs: time.sleep(0.5))
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(bot._llm_chat(model="gpt-3.5-turbo", messages=[]))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(cancel_probe())
+    assert breaker.state == "half-open"
+    assert not breaker.probing
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", lambda **kwargs: {"choices": [], "usage": {}})
+    _call()
+    assert breaker.state == "closed"
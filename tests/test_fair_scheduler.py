@@ -0,0 +1,23 @@
+import asyncio
+
+import bot
+
+
+def test_background_queue_waits_for_users():
+    async def scenario():
+        scheduler = bot.FairScheduler({}, default_limit=1, background=("backfill",))
+        await scheduler.acquire("m", "alice")
+        order = []
+
+        async def worker(user_id):
+            await scheduler.acquire("m", user_id)
+            order.append(user_id)
+            scheduler.release("m")
+
+        tasks = [asyncio.create_task(worker(u)) for u in ("backfill", "bob", "carol")]
+        await asyncio.sleep(0)
+        scheduler.release("m")
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["bob", "carol", "backfill"]
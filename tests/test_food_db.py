@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+from food_db import FoodDatabase
+
+FOODS_CSV = os.path.join(os.path.dirname(__file__), os.pardir, "data", "foods.csv")
+
+
+@pytest.fixture(scope="module")
+def food_db():
+    return FoodDatabase.from_csv(FOODS_CSV)
+
+
+def test_small_bare_number_is_pieces(food_db):
+    assert food_db.lookup("2 банана")["grams"] == 240.0
+    assert food_db.lookup("яйцо 2")["grams"] == 110.0
+
+
+@pytest.mark.parametrize("query", ["банан 150", "яблоко 200", "хлеб белый 50", "огурец 100"])
+def test_large_bare_number_goes_to_llm(food_db, query):
+    assert food_db.lookup(query) is None
+
+
+def test_explicit_grams_still_resolved(food_db):
+    assert food_db.lookup("банан 150 г")["grams"] == 150.0
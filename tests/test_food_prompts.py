@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+import openai
+
+import bot
+
+
+def _answer_with(monkeypatch, items):
+    calls = []
+
+    async def llm_chat(**kwargs):
+        calls.append(kwargs)
+        content = json.dumps({"items": items}, ensure_ascii=False)
+        return openai.openai_object.OpenAIObject.construct_from(
+            {"choices": [{"message": {"content": content}}], "usage": {}})
+    monkeypatch.setattr(bot, "llm_chat", llm_chat)
+    return calls
+
+
+def test_multi_food_line_is_summed(monkeypatch):
+    calls = _answer_with(monkeypatch, [
+        {"name": "овсянка", "grams": 200, "kcal": 176, "p": 6, "f": 3.4, "c": 30},
+        {"name": "кофе", "grams": 250, "kcal": 5, "p": 0.5, "f": 0, "c": 0.8},
+    ])
+    info = asyncio.run(bot._ask_food_info("овсянка 200г, кофе 250мл"))
+    assert info == {"name": "овсянка, кофе", "grams": 450.0, "calories": 181.0,
+                    "protein": 6.5, "fat": 3.4, "carbs": 30.8}
+    assert calls[0]["max_tokens"] >= 2 * 50
+
+
+def test_max_tokens_grow_with_food_count(monkeypatch):
+    calls = _answer_with(monkeypatch, [{"name": "банан", "grams": 120, "kcal": 107, "p": 1.8, "f": 0.2, "c": 26}])
+    asyncio.run(bot._ask_food_info("банан"))
+    asyncio.run(bot._ask_food_info("банан, яблоко, кефир 250 мл и хлеб"))
+    assert calls[1]["max_tokens"] - calls[0]["max_tokens"] == 3 * 50
+
+
+def test_invalid_values_are_rejected(monkeypatch):
+    _answer_with(monkeypatch, [{"name": "банан", "grams": "120", "kcal": 107, "p": 1.8, "f": 0.2, "c": 26}])
+    assert asyncio.run(bot._ask_food_info("банан")) is None
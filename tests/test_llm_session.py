@@ -0,0 +1,12 @@
+import openai
+
+import bot
+
+
+def test_periodic_session_close_keeps_shared_pool():
+    bot._llm_adapter.poolmanager.connection_from_url("http://127.0.0.1:9")
+    pools = len(bot._llm_adapter.poolmanager.pools)
+    session = openai.api_requestor._make_session()
+    assert session is bot._llm_session
+    session.close()  # так openai закрывает сессию потока раз в MAX_SESSION_LIFETIME_SECS
+    assert len(bot._llm_adapter.poolmanager.pools) == pools
@@ -0,0 +1,11 @@
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+import bot
+
+
+def test_metrics_use_prometheus_text_format():
+    response = asyncio.run(bot.handle_metrics(make_mocked_request("GET", "/metrics")))
+    assert response.headers["Content-Type"] == "text/plain; version=0.0.4; charset=utf-8"
+    assert b"foodbot_" in response.body
@@ -0,0 +1,28 @@
+import pytest
+
+import bot
+from storage import open_db
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return bot.NutritionCache(open_db(str(tmp_path / "cache.db")))
+
+
+def _info(name, grams, calories):
+    return {"name": name, "grams": grams, "calories": calories, "protein": 0.0, "fat": 0.0, "carbs": 0.0}
+
+
+def test_single_food_is_rescaled(cache):
+    cache.put("Гречка 200г", _info("гречка", 200.0, 220.0))
+    info = cache.get("гречка 100 г")
+    assert info["grams"] == 100.0
+    assert info["calories"] == 110.0
+    assert cache.rescaled == 1
+
+
+def test_multi_food_is_not_rescaled(cache):
+    cache.put("гречка 200г, кофе 250мл", _info("гречка, кофе", 450.0, 225.0))
+    assert cache.get("гречка 100г, кофе 250мл") is None
+    assert cache.get("гречка 200 г, кофе 250мл")["grams"] == 450.0
+    assert cache.rescaled == 0
@@ -0,0 +1,20 @@
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+import bot
+
+
+def _post(headers):
+    request = make_mocked_request("POST", bot.WEBHOOK_PATH, headers=headers)
+    return asyncio.run(bot.handle_webhook(request))
+
+
+def test_rejects_updates_without_configured_secret(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "")
+    assert _post({}).status == 403
+
+
+def test_rejects_wrong_secret(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "s3cret")
+    assert _post({"X-Telegram-Bot-Api-Secret-Token": "guess"}).status == 403